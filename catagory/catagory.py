@@ -1,6 +1,20 @@
 import json
+import os
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+UNKNOWN = "Unknown"
+
 def load_config(file_path):
     with open(file_path, 'r') as file:
         return json.load(file)
@@ -14,23 +28,321 @@ def categorize_notional(notional, notional_mapping):
             return threshold['label']
     return "Unknown"
 
-# Load configuration
-config_path = "mapping.json"
-config = load_config(config_path)
-product_mapping = config['product_type_mapping']
-notional_mapping = config['notional_size_mapping']
-
-# Sample data
-data = {
-    'Trade ID': [1, 2, 3, 4],
-    'Product': ['Equity Option', 'Bond', 'FX Forward', 'Commodity'],
-    'Notional': [95000, 450000, 2000000, 10500000]
-}
-df = pd.DataFrame(data)
-
-# Apply mappings
-df['Product Type'] = df['Product'].apply(lambda x: categorize_product(x, product_mapping))
-df['Trade Size'] = df['Notional'].apply(lambda x: categorize_notional(x, notional_mapping))
-
-# Display updated DataFrame
-print(df)
\ No newline at end of file
+# Function to compile notional_size_mapping into sorted bin edges and the label
+# of each bin. A value gets the label of the first threshold (in config order)
+# it does not exceed, as in categorize_notional, even if thresholds are unsorted.
+def compile_notional_mapping(notional_mapping):
+    thresholds = np.array([float(entry['threshold']) for entry in notional_mapping])
+    order = np.argsort(thresholds, kind='stable')
+    # for each sorted edge, the earliest config entry among it and all larger edges
+    first = np.minimum.accumulate(order[::-1])[::-1] if len(order) else order
+    labels = [entry['label'] for entry in notional_mapping]
+    return thresholds[order], [labels[position] for position in first], list(dict.fromkeys(labels))
+
+def _categories(labels, default):
+    return list(dict.fromkeys(list(labels) + [default]))
+
+# Maps values of one column through a lookup table. String keys are matched
+# case-insensitively; anything not in the table gets the default.
+class LookupRule:
+    column_type = str
+
+    def __init__(self, output, column, mapping, default=UNKNOWN):
+        self.output = output
+        self.column = column
+        self.default = default
+        self.categories = _categories(mapping.values(), default)
+        position = {category: code for code, category in enumerate(self.categories)}
+        self.table = {_normalize(key): position[label] for key, label in mapping.items()}
+        self.default_code = position[default]
+
+    # Each distinct value is normalized and looked up once
+    def codes(self, values):
+        codes, uniques = pd.factorize(values)
+        lookup = np.array([self.table.get(_normalize(value), self.default_code) for value in uniques]
+                          + [self.default_code])
+        # factorize gives missing values the code -1, which picks the trailing default
+        return lookup[codes]
+
+# Puts values of one numeric column into bins: the label of the first threshold
+# (in config order) the value does not exceed, else the default
+class BinRule:
+    column_type = float
+
+    def __init__(self, output, column, thresholds, default=UNKNOWN):
+        self.output = output
+        self.column = column
+        self.default = default
+        self.edges, bin_labels, labels = compile_notional_mapping(thresholds)
+        self.categories = _categories(labels, default)
+        position = {category: code for code, category in enumerate(self.categories)}
+        self.lookup = np.array([position[label] for label in bin_labels] + [position[default]])
+
+    def codes(self, values):
+        values = pd.to_numeric(values, errors='coerce').to_numpy(dtype=float)
+        # values above the last edge, and NaN, land after it and get the default
+        return self.lookup[np.searchsorted(self.edges, values, side='left')]
+
+def _normalize(value):
+    return value.lower() if isinstance(value, str) else value
+
+# Default rules for configs that only hold the original two mappings
+LEGACY_RULES = [
+    {'output': 'Product Type', 'column': 'Product', 'lookup': 'product_type_mapping'},
+    {'output': 'Trade Size', 'column': 'Notional', 'bins': 'notional_size_mapping'},
+]
+
+# All categorization rules of a config, compiled once. Every rule has fixed
+# categories, so results of separate chunks concatenate without re-coding.
+class RuleSet:
+    def __init__(self, rules):
+        self.rules = rules
+
+    # Function to compile the "rules" list of a config. A rule's "lookup" or
+    # "bins" is either the mapping itself or the name of a top-level mapping.
+    # Configs without "rules" get LEGACY_RULES for the mappings they contain.
+    @classmethod
+    def from_config(cls, config):
+        specs = config.get('rules')
+        if specs is None:
+            specs = [spec for spec in LEGACY_RULES if spec.get('lookup', spec.get('bins')) in config]
+        rules = []
+        for spec in specs:
+            default = spec.get('default', UNKNOWN)
+            if 'lookup' in spec:
+                mapping = spec['lookup']
+                mapping = config[mapping] if isinstance(mapping, str) else mapping
+                rules.append(LookupRule(spec['output'], spec['column'], mapping, default))
+            elif 'bins' in spec:
+                thresholds = spec['bins']
+                thresholds = config[thresholds] if isinstance(thresholds, str) else thresholds
+                rules.append(BinRule(spec['output'], spec['column'], thresholds, default))
+            else:
+                raise ValueError(f"Rule for {spec.get('output')} needs 'lookup' or 'bins'")
+        return cls(rules)
+
+    # Function to apply every rule to a dataframe (or one chunk of a larger
+    # file), returning a copy with one categorical column per rule
+    def apply(self, df):
+        missing = [rule.column for rule in self.rules if rule.column not in df.columns]
+        if missing:
+            raise KeyError(f"Columns not found: {', '.join(missing)}")
+        outputs = {rule.output: pd.Categorical.from_codes(rule.codes(df[rule.column]), rule.categories)
+                   for rule in self.rules}
+        return df.assign(**outputs)
+
+    # Function to apply the rules to an iterable of dataframe chunks
+    def apply_chunks(self, chunks):
+        for chunk in chunks:
+            yield self.apply(chunk)
+
+# Function to classify a whole column of notionals with one binary search per value.
+# Values above the last threshold, and missing values, are "Unknown".
+def categorize_notionals(notionals, notional_mapping):
+    notionals = pd.Series(notionals)
+    rule = BinRule(None, None, notional_mapping)
+    return pd.Series(pd.Categorical.from_codes(rule.codes(notionals), rule.categories), index=notionals.index)
+
+# Function to map a whole column of products to product types. Each distinct
+# product is lowercased and looked up once; the result is a Categorical.
+def categorize_products(products, product_mapping):
+    products = pd.Series(products)
+    rule = LookupRule(None, None, product_mapping)
+    return pd.Series(pd.Categorical.from_codes(rule.codes(products), rule.categories), index=products.index)
+
+
+# A mapping file compiled into a RuleSet once and recompiled only when the
+# file changes. snapshot() checks the file's modification time and reloads
+# under a lock; the new RuleSet replaces the old one in a single assignment,
+# so a batch that already took a snapshot keeps using it until it finishes.
+class MappingConfig:
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self._lock = threading.Lock()
+        self._version = None
+        self._rules = None
+        self.reload()
+
+    def _file_version(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    # Function to recompile the rules if the file changed since the last load.
+    # A file that cannot be read or compiled (e.g. halfway through being
+    # written) is reported once and the previous rules are kept until the
+    # file changes again.
+    def reload(self):
+        with self._lock:
+            version = None
+            try:
+                version = self._file_version()
+                if version == self._version:
+                    return False
+                rules = RuleSet.from_config(load_config(self.path))
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                if self._rules is None:
+                    raise
+                print(f"Keeping previous mappings, could not reload {self.path}: {e}")
+                if version is not None:
+                    self._version = version
+                return False
+            self._rules, self._version = rules, version
+            return True
+
+    # Function to get the current compiled rules, reloading them if needed
+    def snapshot(self):
+        try:
+            changed = self._file_version() != self._version
+        except OSError:
+            changed = False
+        if changed:
+            self.reload()
+        return self._rules
+
+    def apply(self, df):
+        return self.snapshot().apply(df)
+
+_mapping_configs = {}
+_mapping_configs_lock = threading.Lock()
+
+# Function to get the shared MappingConfig of a mapping file, so every caller
+# in the process reuses one compiled copy
+def get_mapping_config(path):
+    path = os.path.abspath(path)
+    with _mapping_configs_lock:
+        if path not in _mapping_configs:
+            _mapping_configs[path] = MappingConfig(path)
+        return _mapping_configs[path]
+
+PARQUET_EXTENSIONS = ('.parquet', '.pq')
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("pyarrow is required to read or write Parquet files")
+
+def _is_parquet(path):
+    return os.path.splitext(str(path))[1].lower() in PARQUET_EXTENSIONS
+
+# Function to read a CSV or Parquet trade file in chunks of chunk_rows rows.
+# Only the given columns are read when columns is not None; dtype declares
+# the types of CSV columns. A column declared float is read as text and
+# converted, so values that are not numbers become NaN instead of failing.
+def iter_trade_chunks(path, chunk_rows, columns=None, dtype=None):
+    if _is_parquet(path):
+        _require_pyarrow()
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows, columns=columns):
+            yield batch.to_pandas()
+        return
+    dtype = dict(dtype or {})
+    numeric = [column for column, column_type in dtype.items() if column_type == 'float64']
+    dtype.update({column: 'object' for column in numeric})
+    for chunk in pd.read_csv(path, chunksize=chunk_rows, usecols=columns, dtype=dtype or None):
+        for column in numeric:
+            chunk[column] = pd.to_numeric(chunk[column], errors='coerce').astype('float64')
+        yield chunk
+
+# pandas and Arrow types for the column_types of a config (Python types, as in df_agg)
+CSV_DTYPES = {float: 'float64', int: 'Int64', str: 'object', bool: 'boolean'}
+ARROW_TYPES = {float: 'float64', int: 'int64', str: 'string', bool: 'bool'}
+
+# Function to fix the types of a trade file before any of it is read, so every
+# chunk is written with the same schema. Rule input columns are float64 (bins)
+# or string (lookups); other CSV columns are kept as text unless column_types
+# declares them, and Parquet columns keep the file's own types. Returns the
+# dtypes to read CSV input with (None for Parquet) and the output Arrow schema.
+def categorize_schema(input_path, rules, column_types=None):
+    category = pa.dictionary(pa.int32(), pa.string())
+    rule_types = {rule.column: rule.column_type for rule in rules.rules}
+    if _is_parquet(input_path):
+        dtypes = None
+        fields = {field.name: field.type for field in pq.read_schema(input_path)}
+    else:
+        types = {column: str for column in pd.read_csv(input_path, nrows=0).columns}
+        types.update({column: column_type for column, column_type in (column_types or {}).items() if column in types})
+        types.update({column: column_type for column, column_type in rule_types.items() if column in types})
+        unsupported = [column for column, column_type in types.items() if column_type not in CSV_DTYPES]
+        if unsupported:
+            raise TypeError(f"Unsupported column types for: {', '.join(unsupported)}")
+        dtypes = {column: CSV_DTYPES[column_type] for column, column_type in types.items()}
+        fields = {column: pa.type_for_alias(ARROW_TYPES[column_type]) for column, column_type in types.items()}
+    for rule in rules.rules:
+        fields[rule.output] = category
+    return dtypes, pa.schema(list(fields.items()))
+
+_worker_rules = None
+
+# Process pool initializer: receive the compiled rules once per worker
+def _init_worker(rules):
+    global _worker_rules
+    _worker_rules = rules
+
+def _apply_worker_rules(chunk):
+    return _worker_rules.apply(chunk)
+
+# Function to categorize a trade file larger than memory: it is read in row
+# chunks, the rules are applied to each chunk and the result is appended to a
+# Parquet file, in input order. With workers > 1 chunks are categorized on a
+# process pool; at most 2 * workers chunks are in flight, so memory stays
+# bounded by a few chunks whatever the file size. Returns the number of rows.
+# rules may be a MappingConfig, in which case the whole file uses one snapshot.
+# The output schema is fixed up front by categorize_schema (see column_types).
+def categorize_file(input_path, output_path, rules, chunk_rows=1_000_000, workers=None, column_types=None):
+    _require_pyarrow()
+    if isinstance(rules, MappingConfig):
+        rules = rules.snapshot()
+    dtypes, schema = categorize_schema(input_path, rules, column_types)
+    chunks = iter_trade_chunks(input_path, chunk_rows, dtype=dtypes)
+    writer, rows = None, 0
+
+    def write(result):
+        nonlocal writer, rows
+        table = pa.Table.from_pandas(result, schema=schema, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(output_path, schema)
+        writer.write_table(table)
+        rows += len(result)
+
+    try:
+        if not workers or workers <= 1:
+            for result in rules.apply_chunks(chunks):
+                write(result)
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(rules,)) as pool:
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(pool.submit(_apply_worker_rules, chunk))
+                    if len(pending) >= 2 * workers:
+                        write(pending.popleft().result())
+                while pending:
+                    write(pending.popleft().result())
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+if __name__ == "__main__" and len(sys.argv) > 2:
+    # python catagory.py <input.csv|input.parquet> <output.parquet> [mapping.json] [chunk_rows] [workers]
+    config_path = sys.argv[3] if len(sys.argv) > 3 else "mapping.json"
+    chunk_rows = int(sys.argv[4]) if len(sys.argv) > 4 else 1_000_000
+    workers = int(sys.argv[5]) if len(sys.argv) > 5 else None
+    rows = categorize_file(sys.argv[1], sys.argv[2], get_mapping_config(config_path), chunk_rows, workers)
+    print(f"Categorized {rows} trades into {sys.argv[2]}")
+elif __name__ == "__main__":
+    # Load configuration
+    config_path = "mapping.json"
+    rules = get_mapping_config(config_path)
+
+    # Sample data
+    data = {
+        'Trade ID': [1, 2, 3, 4],
+        'Product': ['Equity Option', 'Bond', 'FX Forward', 'Commodity'],
+        'Notional': [95000, 450000, 2000000, 10500000],
+        'Maturity': [0.5, 2, 7, 30]
+    }
+    df = pd.DataFrame(data)
+
+    # Apply mappings
+    df = rules.apply(df)
+
+    # Display updated DataFrame
+    print(df)
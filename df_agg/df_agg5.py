@@ -1,74 +1,337 @@
+import ast
 import pandas as pd
 import numpy as np
-import re
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
 
 def is_numeric_type(dtype):
-    return np.issubdtype(dtype, np.number)
+    # numbers only, as np.issubdtype(dtype, np.number), but also for pandas extension dtypes
+    return pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
 
-def filter_dataframe(df, filter_config, column_types):
-    column = filter_config['column']
-    operation = filter_config['operation']
+def is_string_type(dtype):
+    # object columns as well as pandas' dedicated string dtype
+    return pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype)
+
+# Rough relative cost of evaluating one predicate; within an AND / OR group
+# cheaper predicates run first, and later ones only see undecided rows
+FILTER_COSTS = {'>': 1, '<': 1, '==': 2, '!=': 2, 'isin': 3}
+
+# Function to normalize a filter config node: a single predicate
+# {column, operation, value}, a list of nodes (all must hold), or
+# {"and": [...]} / {"or": [...]}. Returns (combinator, children) or (None, predicate).
+def filter_node(filter_config):
+    if isinstance(filter_config, list):
+        return 'and', filter_config
+    for combinator in ('and', 'or'):
+        if combinator in filter_config:
+            return combinator, filter_config[combinator]
+    return None, filter_config
+
+def filter_cost(filter_config):
+    combinator, children = filter_node(filter_config)
+    if combinator is None:
+        return FILTER_COSTS.get(children['operation'], 3)
+    return sum(filter_cost(child) for child in children)
+
+# Function to list the columns a filter config uses
+def filter_columns(filter_config):
+    combinator, children = filter_node(filter_config)
+    if combinator is None:
+        return [children['column']]
+    return list(dict.fromkeys(column for child in children for column in filter_columns(child)))
+
+def check_predicate(df, predicate):
+    column = predicate['column']
+    operation = predicate['operation']
     if operation in ['==', '!=']:
-        if not df[column].dtype == object:
+        if not is_string_type(df[column].dtype):
             raise TypeError(f"Invalid type for operation '{operation}' on column '{column}'")
     if operation in ['>', '<']:
         if not is_numeric_type(df[column].dtype):
             raise TypeError(f"Invalid type for operation '{operation}' on column '{column}'")
-    if operation == 'isin' and not isinstance(filter_config['value'], list):
+    if operation == 'isin' and not isinstance(predicate['value'], list):
         raise TypeError(f"'isin' operation requires a list of values for column '{column}'")
+    if operation not in FILTER_COSTS:
+        raise ValueError(f"Unsupported filter operation '{operation}' on column '{column}'")
+
+def _predicate_mask(df, predicate, rows):
+    values = df[predicate['column']]
+    if rows is not None:
+        values = values.iloc[rows]
+    operation, value = predicate['operation'], predicate['value']
     if operation == '==':
-        df = df[df[column] == filter_config['value']]
+        result = values == value
     elif operation == '!=':
-        df = df[df[column] != filter_config['value']]
+        result = values != value
     elif operation == '>':
-        df = df[df[column] > filter_config['value']]
+        result = values > value
     elif operation == '<':
-        df = df[df[column] < filter_config['value']]
-    elif operation == 'isin':
-        df = df[df[column].isin(filter_config['value'])]
-    return df
+        result = values < value
+    else:
+        result = values.isin(value)
+    return result.to_numpy(dtype=bool, na_value=False)
 
-def groupby_and_aggregate(df, groupby_config, column_types):
+# Function to evaluate a filter config into one boolean NumPy mask, over all
+# rows or only the given row positions
+def filter_mask(df, filter_config, column_types, rows=None):
+    combinator, children = filter_node(filter_config)
+    if combinator is None:
+        check_predicate(df, children)
+        return _predicate_mask(df, children, rows)
+
+    size = len(df) if rows is None else len(rows)
+    is_and = combinator == 'and'
+    mask = np.full(size, is_and)
+    for child in sorted(children, key=filter_cost):
+        # rows an AND has already rejected, or an OR already accepted, are decided
+        undecided = np.flatnonzero(mask) if is_and else np.flatnonzero(~mask)
+        if len(undecided) == 0:
+            break
+        if 2 * len(undecided) < size:
+            positions = undecided if rows is None else rows[undecided]
+            mask[undecided] = filter_mask(df, child, column_types, positions)
+        elif is_and:
+            mask &= filter_mask(df, child, column_types, rows)
+        else:
+            mask |= filter_mask(df, child, column_types, rows)
+    return mask
+
+# Function to filter a DataFrame with a single predicate or a compound filter
+# config; the predicates are combined into one mask and the rows taken once
+def filter_dataframe(df, filter_config, column_types):
+    return df.take(np.flatnonzero(filter_mask(df, filter_config, column_types)))
+
+def check_aggregations(df, groupby_config):
     for column, agg_func in groupby_config['aggregations'].items():
         column_dtype = df[column].dtype
         if agg_func in ['sum', 'mean', 'median'] and not is_numeric_type(column_dtype):
             raise TypeError(f"Invalid type for aggregation '{agg_func}' on column '{column}'")
+
+def groupby_and_aggregate(df, groupby_config, column_types):
+    check_aggregations(df, groupby_config)
     grouped = df.groupby(groupby_config['groupby_columns'])
     aggregated_df = grouped.agg(groupby_config['aggregations'])
     return aggregated_df
 
-def parse_formula(formula):
-    function_patterns = re.findall(r'(\w+)\((\w+)\)', formula)
-    for func, column in function_patterns:
-        if func == 'pct_change':
-            formula = formula.replace(f'{func}({column})', f'{column}.pct_change()')
-        # Additional function translations can be added here
-    return formula
-
-def is_formula_valid(formula, allowed_operations):
-    """
-    Validates the formula by checking if it contains only allowed operations.
-    """
-    # Extract all words (potential function names) from the formula
-    words = re.findall(r'\b\w+\b', formula)
-
-    for word in words:
-        if word not in allowed_operations and not word.isnumeric() and word not in allowed_operations:
-            print(f"Disallowed operation or function: {word}")
-            return False
-    return True
+# Calculation functions, applied to NumPy arrays in row order
+def _shift(values, periods=1):
+    periods = int(periods)
+    result = np.full(values.shape, np.nan)
+    if periods >= 0:
+        result[periods:] = values[:len(values) - periods]
+    else:
+        result[:periods] = values[-periods:]
+    return result
+
+def _diff(values, periods=1):
+    return values - _shift(values, periods)
+
+def _pct_change(values, periods=1):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return values / _shift(values, periods) - 1
+
+CALCULATION_FUNCTIONS = {
+    'pct_change': _pct_change, 'diff': _diff, 'lag': _shift, 'shift': _shift,
+    'abs': np.abs, 'log': np.log, 'exp': np.exp, 'sqrt': np.sqrt, 'minimum': np.minimum, 'maximum': np.maximum,
+}
+_CALCULATION_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Load, ast.Constant,
+                      ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd)
+
+# A calculation formula parsed and validated once. Names must be columns of
+# the frame schema it was compiled for (or functions from
+# CALCULATION_FUNCTIONS); it then runs on NumPy arrays without re-parsing,
+# through numexpr when it calls no functions and numexpr is installed.
+class CompiledCalculation:
+    def __init__(self, new_column, formula, columns):
+        self.new_column = new_column
+        self.formula = formula
+        try:
+            tree = ast.parse(formula, mode='eval')
+        except SyntaxError as e:
+            raise ValueError(f"Invalid formula for {new_column}: {formula} ({e.msg})")
+        functions = set()
+        for node in ast.walk(tree):
+            if not isinstance(node, _CALCULATION_NODES):
+                raise ValueError(f"Disallowed operation in formula: {formula}")
+            if isinstance(node, ast.Call):
+                if not isinstance(node.func, ast.Name) or node.func.id not in CALCULATION_FUNCTIONS or node.keywords:
+                    raise ValueError(f"Disallowed function in formula: {formula}")
+                functions.add(id(node.func))
+            elif isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+                raise ValueError(f"Disallowed constant in formula: {formula}")
+        self.columns = []
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and id(node) not in functions:
+                if node.id not in columns:
+                    raise ValueError(f"Unknown column '{node.id}' in formula: {formula}")
+                if node.id not in self.columns:
+                    self.columns.append(node.id)
+        self.code = compile(tree, f'<calculation {new_column}>', 'eval')
+        self.numexpr_formula = None
+        if numexpr is not None and not functions:
+            # numexpr would compute integer constants in int64, which can overflow;
+            # as floats they give the same result as the columns, which are floats
+            try:
+                for node in ast.walk(tree):
+                    if isinstance(node, ast.Constant):
+                        node.value = float(node.value)
+                self.numexpr_formula = ast.unparse(tree)
+            except OverflowError:
+                pass
+
+    def evaluate(self, arrays):
+        namespace = {column: arrays[column] for column in self.columns}
+        if self.numexpr_formula is not None:
+            try:
+                return numexpr.evaluate(self.numexpr_formula, local_dict=namespace)
+            except (ZeroDivisionError, OverflowError):
+                # numexpr folds constant sub-expressions in Python while compiling, so
+                # e.g. A / 0 raises there; NumPy gives inf / NaN
+                self.numexpr_formula = None
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return eval(self.code, {'__builtins__': {}, **CALCULATION_FUNCTIONS}, namespace)
+
+_compiled_calculations = {}
+
+# Function to compile a calculations config for a frame with the given
+# columns. Each calculation may use the columns and earlier new columns.
+# Compiled configs are cached, so repeated batches skip parsing entirely.
+def compile_calculations(calculations_config, columns):
+    key = (tuple((calc.get('new_column'), calc.get('formula')) for calc in calculations_config), tuple(columns))
+    if key not in _compiled_calculations:
+        available = set(columns)
+        compiled = []
+        for calc in calculations_config:
+            if 'formula' not in calc:
+                raise ValueError(f"Unsupported operation or missing formula in calculations: {calc}")
+            compiled.append(CompiledCalculation(calc['new_column'], calc['formula'], available))
+            available.add(calc['new_column'])
+        _compiled_calculations[key] = compiled
+    return _compiled_calculations[key]
 
 def calculate_columns(df, calculations_config, column_types):
-    allowed_operations = ["pct_change", "+", "-", "*", "/", "MTM", "NOTIONAL"]  # Include column names and operations
-    for calc in calculations_config:
-        if 'formula' in calc:
-            formula = calc['formula']
-            translated_formula = parse_formula(formula)
-            if not is_formula_valid(translated_formula, allowed_operations):
-                raise ValueError(f"Disallowed operation in formula: {translated_formula}")
-            df[calc['new_column']] = df.eval(translated_formula)
-        else:
-            raise ValueError(f"Unsupported operation or missing formula in calculations: {calc}")
+    arrays = {}
+    for calc in compile_calculations(calculations_config, df.columns):
+        for column in calc.columns:
+            if column not in arrays:
+                if not is_numeric_type(df[column].dtype):
+                    raise TypeError(f"Invalid type for calculation on column '{column}'")
+                arrays[column] = df[column].to_numpy(dtype=float)
+        arrays[calc.new_column] = np.broadcast_to(calc.evaluate(arrays), len(df)).astype(float)
+        df[calc.new_column] = arrays[calc.new_column]
+    return df
+
+# Window functions over ordered segments (one segment per group). Each takes
+# the sorted values, the group id of every sorted row, the position of every
+# row within its group, and the function's spec.
+def _segment_shift(values, group_ids, positions, periods):
+    result = np.full(len(values), np.nan)
+    source = np.arange(len(values)) - periods
+    if periods >= 0:
+        valid = positions >= periods
+    else:
+        valid = source < len(values)
+        valid[valid] = group_ids[source[valid]] == group_ids[valid]
+    result[valid] = values[source[valid]]
+    return result
+
+# Rolling windows up to this size are summed from shifted copies of the
+# values, which is exact; larger ones from running sums restarted per segment
+ROLLING_SHIFT_LIMIT = 32
+
+def _segment_rolling_sum(values, group_ids, positions, window):
+    # a window with any missing value, or not yet full, is NaN, like pandas' rolling
+    if window <= ROLLING_SHIFT_LIMIT:
+        result = values.copy()
+        for periods in range(1, window):
+            result += _segment_shift(values, group_ids, positions, periods)
+        return result
+    present = ~np.isnan(values)
+    # running sums restart at every segment, so one group's magnitudes cannot swamp another's
+    sums = pd.Series(np.where(present, values, 0.0)).groupby(group_ids).cumsum().to_numpy()
+    counts = np.concatenate([[0], np.cumsum(present)])
+    end = np.arange(len(values))
+    before = end - window  # the row just before each window
+    previous = np.where(positions >= window, sums[np.maximum(before, 0)], 0.0)
+    full = (positions >= window - 1) & (counts[end + 1] - counts[np.maximum(before + 1, 0)] == window)
+    result = np.full(len(values), np.nan)
+    result[full] = sums[full] - previous[full]
+    return result
+
+def _window_function(function, values, group_ids, positions, spec):
+    periods = int(spec.get('periods', 1))
+    if function == 'lag':
+        return _segment_shift(values, group_ids, positions, periods)
+    if function == 'diff':
+        return values - _segment_shift(values, group_ids, positions, periods)
+    if function == 'pct_change':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return values / _segment_shift(values, group_ids, positions, periods) - 1
+    if function in ('rolling_sum', 'rolling_mean'):
+        window = int(spec['window'])
+        if window < 1:
+            raise ValueError(f"Rolling window must be at least 1: {spec}")
+        sums = _segment_rolling_sum(values, group_ids, positions, window)
+        return sums if function == 'rolling_sum' else sums / window
+    raise ValueError(f"Unsupported window function '{function}' in window calculations: {spec}")
+
+WINDOW_FUNCTIONS = ('lag', 'diff', 'pct_change', 'rolling_sum', 'rolling_mean')
+
+# Function to get a column, or an index level (e.g. a groupby key), as an array
+def _column_values(df, column):
+    if column in df.columns:
+        return df[column]
+    if column in (df.index.names or []):
+        return pd.Series(df.index.get_level_values(column), index=df.index)
+    raise ValueError(f"Column '{column}' not found for window calculations")
+
+# Function to add window calculations (lag, diff, pct_change, rolling_sum,
+# rolling_mean) computed per partition_by group in order_by order. Rows are
+# sorted once; every function then runs as vectorized operations over the
+# sorted segments, and results are written back in the frame's own row order.
+def window_columns(df, window_config, column_types):
+    partition_by = window_config.get('partition_by', [])
+    order_by = window_config['order_by']
+    order = _column_values(df, order_by)
+    if not is_numeric_type(order.dtype) and not pd.api.types.is_datetime64_any_dtype(order.dtype):
+        try:
+            order = pd.to_datetime(order)
+        except (TypeError, ValueError) as e:
+            raise TypeError(f"Column '{order_by}' cannot be used to order window calculations: {e}")
+    keys = [pd.factorize(_column_values(df, column))[0] for column in partition_by]
+    # np.lexsort sorts by the last key first: partition columns, then time
+    sort = np.lexsort([order.to_numpy()] + keys[::-1]) if len(df) else np.arange(0)
+    if keys:
+        sorted_keys = np.vstack([key[sort] for key in keys])
+        starts = np.concatenate([[True], (sorted_keys[:, 1:] != sorted_keys[:, :-1]).any(axis=0)])
+    else:
+        starts = np.zeros(len(df), dtype=bool)
+        starts[:1] = True
+    group_ids = np.cumsum(starts) - 1
+    first = np.flatnonzero(starts)
+    positions = np.arange(len(df)) - first[group_ids] if len(df) else np.arange(0)
+
+    for spec in window_config['calculations']:
+        column = spec['column']
+        values = _column_values(df, column)
+        if not is_numeric_type(values.dtype):
+            raise TypeError(f"Invalid type for window function '{spec['function']}' on column '{column}'")
+        result = np.empty(len(df))
+        result[sort] = _window_function(spec['function'], values.to_numpy(dtype=float)[sort], group_ids,
+                                        positions, spec)
+        df[spec['new_column']] = result
+    return df
+
+# Function to run the steps that follow the groupby: window calculations, then calculations
+def finish_dataframe(df, config):
+    column_types = config.get('column_types', {})
+    if config.get('window'):
+        df = window_columns(df, config['window'], column_types)
+    if config.get('calculations'):
+        df = calculate_columns(df, config['calculations'], column_types)
     return df
 
 # Sample configuration with function-like format in calculation
@@ -95,15 +358,37 @@ config = {
     ]
 }
 
-# Load the data
-file_path = 'df_agg/df.csv'  # Path to the uploaded CSV file
-df = pd.read_csv(file_path)
+# Sample configuration computing day over day changes per product
+window_config = {
+    "column_types": config["column_types"],
+    "filter": config["filter"],
+    "groupby": {
+        "groupby_columns": ["PRODUCT", "ASOF_DATE"],
+        "aggregations": {"MTM": "sum", "NOTIONAL": "sum"}
+    },
+    "window": {
+        "partition_by": ["PRODUCT"],
+        "order_by": "ASOF_DATE",
+        "calculations": [
+            {"new_column": "MTM_CHANGE", "function": "pct_change", "column": "MTM"},
+            {"new_column": "NOTIONAL_MEAN_3", "function": "rolling_mean", "column": "NOTIONAL", "window": 3}
+        ]
+    }
+}
 
-# Apply the configuration to the DataFrame
-try:
-    filtered_df = filter_dataframe(df, config['filter'], config['column_types'])
-    grouped_df = groupby_and_aggregate(filtered_df, config['groupby'], config['column_types'])
-    calculated_df = calculate_columns(grouped_df, config['calculations'], config['column_types'])
-    print(calculated_df.head())
-except (TypeError, ValueError) as e:
-    print(f"Error in configuration: {e}")
\ No newline at end of file
+if __name__ == "__main__":
+    # Load the data
+    file_path = 'df_agg/df.csv'  # Path to the uploaded CSV file
+    df = pd.read_csv(file_path)
+
+    # Apply the configuration to the DataFrame
+    try:
+        filtered_df = filter_dataframe(df, config['filter'], config['column_types'])
+        grouped_df = groupby_and_aggregate(filtered_df, config['groupby'], config['column_types'])
+        calculated_df = calculate_columns(grouped_df, config['calculations'], config['column_types'])
+        print(calculated_df.head())
+
+        grouped_df = groupby_and_aggregate(filtered_df, window_config['groupby'], window_config['column_types'])
+        print(finish_dataframe(grouped_df, window_config).head(10))
+    except (TypeError, ValueError) as e:
+        print(f"Error in configuration: {e}")
\ No newline at end of file
@@ -0,0 +1,149 @@
+import glob
+import hashlib
+import os
+import pickle
+import sys
+import tempfile
+import pandas as pd
+from df_agg5 import config, filter_columns, filter_dataframe, finish_dataframe, is_numeric_type
+from df_agg_lazy import LazyPipeline, source_columns
+from df_agg_parallel import COMBINE, PARTIAL_AGGREGATIONS, finish_aggregates
+
+DEFAULT_DIMENSIONS = ['BUSINESS', 'PRODUCT', 'ASOF_DATE']
+CUBE_PARTIALS = ['sum', 'count', 'min', 'max']
+
+# Function to identify the current contents of a source file cheaply: any
+# rewrite changes its size or modification time
+def source_fingerprint(path):
+    stat = os.stat(path)
+    return f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}'
+
+def _hash(text):
+    return hashlib.sha256(text.encode()).hexdigest()[:32]
+
+# Function to build a cube: one row per combination of the dimension columns,
+# with the row count and sum / count / min / max of every numeric measure.
+# The source is read in chunks, so memory is bounded by the cube size.
+# Measures are the numeric columns of the first chunk; one that is not numeric
+# in a later chunk (e.g. a '#REF' cell) is dropped from the whole cube, so
+# queries on it scan the file and fail as the eager path does.
+def build_cube(path, dimensions, chunk_rows=1_000_000):
+    columns = source_columns(path)
+    missing = [dimension for dimension in dimensions if dimension not in columns]
+    if missing:
+        raise ValueError(f"Cube dimensions not found in {path}: {', '.join(missing)}")
+    cube, measures = None, None
+    for chunk in LazyPipeline(path, {}, chunk_rows).iter_scan():
+        if measures is None:
+            measures = [column for column in chunk.columns
+                        if column not in dimensions and is_numeric_type(chunk[column].dtype)]
+        dropped = [column for column in measures if not is_numeric_type(chunk[column].dtype)]
+        if dropped:
+            measures = [column for column in measures if column not in dropped]
+            if cube is not None:
+                cube = cube.drop(columns=[f'{column}__{func}' for column in dropped for func in CUBE_PARTIALS])
+        named = {'_group__size': (dimensions[0], 'size')}
+        for column in measures:
+            for func in CUBE_PARTIALS:
+                named[f'{column}__{func}'] = (column, func)
+        partials = chunk.groupby(dimensions, dropna=False).agg(**named)
+        if cube is not None:
+            # keep rows with missing dimensions, a roll-up over other dimensions still counts them
+            partials = pd.concat([cube, partials])
+            combine = {name: COMBINE[name.rsplit('__', 1)[1]] for name in partials.columns}
+            partials = partials.groupby(level=dimensions, dropna=False).agg(combine)
+        cube = partials
+    return cube
+
+# On-disk store of cubes, one pickle per (source file, dimensions). A cube
+# whose source fingerprint no longer matches is replaced, and the least
+# recently used cubes are evicted once the store grows beyond max_bytes.
+class CubeCache:
+    def __init__(self, directory, max_bytes=1 << 30, dimensions=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.dimensions = list(dimensions or DEFAULT_DIMENSIONS)
+        os.makedirs(directory, exist_ok=True)
+
+    def _prefix(self, path):
+        return _hash(f"{os.path.abspath(path)}|{','.join(self.dimensions)}")
+
+    def _path(self, path):
+        return os.path.join(self.directory, f'{self._prefix(path)}_{_hash(source_fingerprint(path))}.pkl')
+
+    # Function to get the cube of a source file, building it if it is not cached
+    def cube(self, path, chunk_rows=1_000_000):
+        cube_path = self._path(path)
+        try:
+            with open(cube_path, 'rb') as file:
+                cube = pickle.load(file)
+            os.utime(cube_path)
+            return cube
+        except (FileNotFoundError, pickle.UnpicklingError, EOFError):
+            pass
+
+        cube = build_cube(path, self.dimensions, chunk_rows)
+        # cubes of earlier versions of the same file are stale now
+        for stale in glob.glob(os.path.join(self.directory, f'{self._prefix(path)}_*.pkl')):
+            os.remove(stale)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            pickle.dump(cube, file)
+        os.replace(temp_path, cube_path)
+        self.evict()
+        return cube
+
+    # Function to delete least recently used cubes until the store fits
+    def evict(self):
+        entries = sorted(glob.glob(os.path.join(self.directory, '*.pkl')), key=os.path.getmtime)
+        size = sum(os.path.getsize(entry) for entry in entries)
+        for entry in entries[:-1]:  # never the cube just written
+            if size <= self.max_bytes:
+                break
+            size -= os.path.getsize(entry)
+            os.remove(entry)
+
+    # Function to tell whether a config can be answered from a cube: it
+    # groups and filters only on dimensions, and only uses aggregations that
+    # roll up (sum, count, min, max, mean). With the cube, also check that
+    # every aggregated column is one of its numeric measures.
+    def can_answer(self, config, cube=None):
+        groupby = config.get('groupby')
+        if groupby is None:
+            return False
+        if any(column not in self.dimensions for column in groupby['groupby_columns']):
+            return False
+        if config.get('filter') is not None and any(column not in self.dimensions
+                                                    for column in filter_columns(config['filter'])):
+            return False
+        for column, agg_func in groupby['aggregations'].items():
+            if agg_func not in PARTIAL_AGGREGATIONS:
+                return False
+            if cube is not None and f'{column}__sum' not in cube.columns:
+                return False
+        return True
+
+    # Function to run a config against a source file, rolling up from the
+    # cached cube when possible and scanning the file otherwise
+    def query(self, path, config, chunk_rows=1_000_000):
+        cube = self.cube(path, chunk_rows) if self.can_answer(config) else None
+        if cube is None or not self.can_answer(config, cube):
+            return LazyPipeline(path, config, chunk_rows).collect()
+        column_types = config.get('column_types', {})
+        rows = cube.reset_index()
+        if config.get('filter') is not None:
+            rows = filter_dataframe(rows, config['filter'], column_types)
+        groupby = config['groupby']
+        keys = groupby['groupby_columns']
+        needed = ['_group__size'] + [f'{column}__{func}' for column, agg_func in groupby['aggregations'].items()
+                                     for func in PARTIAL_AGGREGATIONS[agg_func]]
+        rolled = rows.groupby(keys).agg({name: COMBINE[name.rsplit('__', 1)[1]] for name in dict.fromkeys(needed)})
+        result = finish_aggregates(rolled, groupby)
+        return finish_dataframe(result, config)
+
+if __name__ == "__main__":
+    cache = CubeCache(sys.argv[1] if len(sys.argv) > 1 else os.path.join(tempfile.gettempdir(), 'df_agg_cubes'))
+    try:
+        print(cache.query('df_agg/df.csv', config).head())
+    except (TypeError, ValueError) as e:
+        print(f"Error in configuration: {e}")
@@ -0,0 +1,173 @@
+import os
+import re
+import pandas as pd
+from df_agg5 import (calculate_columns, config, filter_columns, filter_dataframe, filter_node, groupby_and_aggregate,
+                     window_columns)
+
+try:
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pc = ds = pq = None
+
+PARQUET_EXTENSIONS = ('.parquet', '.pq')
+
+def is_parquet(path):
+    return os.path.splitext(str(path))[1].lower() in PARQUET_EXTENSIONS
+
+# Function to list the columns of a CSV or Parquet file without reading its rows
+def source_columns(path):
+    if is_parquet(path):
+        if pq is None:
+            raise ImportError("pyarrow is required to read Parquet files")
+        return list(pq.read_schema(path).names)
+    return list(pd.read_csv(path, nrows=0).columns)
+
+# Function to find which of the given columns a calculation formula uses
+def formula_columns(formula, columns):
+    words = set(re.findall(r'\b\w+\b', formula))
+    return [column for column in columns if column in words]
+
+# Function to convert a filter config to a pyarrow filter expression
+def arrow_filter(filter_config):
+    combinator, children = filter_node(filter_config)
+    if combinator is not None:
+        expressions = [arrow_filter(child) for child in children]
+        expression = expressions[0]
+        for other in expressions[1:]:
+            expression = expression & other if combinator == 'and' else expression | other
+        return expression
+    field, operation, value = pc.field(children['column']), children['operation'], children['value']
+    if operation == '==':
+        return field == value
+    if operation == '!=':
+        # Arrow gives null for null cells, which drops them; pandas keeps them (NaN != value)
+        return (field != value) | field.is_null()
+    if operation == '>':
+        return field > value
+    if operation == '<':
+        return field < value
+    return field.isin(value)
+
+# A filter -> groupby -> window -> calculate pipeline over a CSV or Parquet file,
+# planned before anything is read. Only the columns the config uses are
+# read, the filter is applied while reading (by pyarrow for Parquet, chunk by
+# chunk for CSV), so neither the full file nor an unfiltered copy of it is
+# ever in memory at once.
+class LazyPipeline:
+    def __init__(self, path, config, chunk_rows=1_000_000):
+        self.path = path
+        self.config = config
+        self.chunk_rows = chunk_rows
+        self.plan = self._build_plan()
+
+    def _build_plan(self):
+        schema = source_columns(self.path)
+        filter_config = self.config.get('filter')
+        groupby = self.config.get('groupby')
+        window = self.config.get('window')
+        calculations = self.config.get('calculations', [])
+
+        if groupby is not None:
+            needed = list(groupby['groupby_columns']) + list(groupby['aggregations'])
+        elif calculations or window:
+            needed = [column for calc in calculations for column in formula_columns(calc.get('formula', ''), schema)]
+            if window:
+                needed += list(window.get('partition_by', [])) + [window['order_by']]
+                needed += [spec['column'] for spec in window['calculations']]
+        else:
+            needed = list(schema)
+        if filter_config is not None:
+            needed += filter_columns(filter_config)
+        missing = [column for column in needed if column not in schema]
+        if missing:
+            raise ValueError(f"Columns not found in {self.path}: {', '.join(dict.fromkeys(missing))}")
+        columns = [column for column in schema if column in needed]
+
+        plan = [{'step': 'scan', 'path': self.path, 'format': 'parquet' if is_parquet(self.path) else 'csv',
+                 'columns': columns, 'filter': filter_config}]
+        if groupby is not None:
+            plan.append({'step': 'groupby', 'groupby': groupby})
+        if window:
+            plan.append({'step': 'window', 'window': window})
+        if calculations:
+            plan.append({'step': 'calculate', 'calculations': calculations})
+        return plan
+
+    # Function to describe the plan, one line per step
+    def explain(self):
+        lines = []
+        for step in self.plan:
+            if step['step'] == 'scan':
+                pushed = f", filter {step['filter']}" if step['filter'] is not None else ''
+                lines.append(f"scan {step['format']} {step['path']} columns {step['columns']}{pushed}")
+            elif step['step'] == 'groupby':
+                lines.append(f"groupby {step['groupby']['groupby_columns']} agg {step['groupby']['aggregations']}")
+            elif step['step'] == 'window':
+                window = step['window']
+                lines.append(f"window partition by {window.get('partition_by', [])} order by {window['order_by']} "
+                             f"{[spec['new_column'] for spec in window['calculations']]}")
+            else:
+                lines.append(f"calculate {[calc['new_column'] for calc in step['calculations']]}")
+        return '\n'.join(lines)
+
+    def _check_parquet_filter(self, step):
+        if step['filter'] is not None:
+            # check the filter against the column types before pyarrow applies it
+            empty = pq.read_schema(self.path).empty_table().select(step['columns']).to_pandas()
+            filter_dataframe(empty, step['filter'], self.config.get('column_types', {}))
+
+    def _scan(self, step):
+        if step['format'] == 'parquet':
+            self._check_parquet_filter(step)
+            filters = arrow_filter(step['filter']) if step['filter'] is not None else None
+            return pq.read_table(self.path, columns=step['columns'], filters=filters).to_pandas()
+        parts = list(self._iter_scan(step))
+        return pd.concat(parts) if parts else pd.DataFrame(columns=step['columns'])
+
+    # Function to read and filter the source chunk by chunk (chunk_rows rows read at a time)
+    def _iter_scan(self, step):
+        column_types = self.config.get('column_types', {})
+        filter_config = step['filter']
+        if step['format'] == 'parquet':
+            self._check_parquet_filter(step)
+            filters = arrow_filter(filter_config) if filter_config is not None else None
+            dataset = ds.dataset(self.path, format='parquet')
+            for batch in dataset.to_batches(columns=step['columns'], filter=filters, batch_size=self.chunk_rows):
+                yield batch.to_pandas()
+            return
+        dtypes = {column: column_type for column, column_type in column_types.items() if column in step['columns']}
+        for chunk in pd.read_csv(self.path, usecols=step['columns'], dtype=dtypes, chunksize=self.chunk_rows):
+            yield filter_dataframe(chunk, filter_config, column_types) if filter_config is not None else chunk
+
+    # Function to run only the scan step: the filtered rows of the used columns
+    def scan(self):
+        return self._scan(self.plan[0])
+
+    # Function to run only the scan step, yielding filtered chunks
+    def iter_scan(self):
+        return self._iter_scan(self.plan[0])
+
+    # Function to execute the plan and return the resulting DataFrame
+    def collect(self):
+        column_types = self.config.get('column_types', {})
+        df = None
+        for step in self.plan:
+            if step['step'] == 'scan':
+                df = self._scan(step)
+            elif step['step'] == 'groupby':
+                df = groupby_and_aggregate(df, step['groupby'], column_types)
+            elif step['step'] == 'window':
+                df = window_columns(df, step['window'], column_types)
+            else:
+                df = calculate_columns(df, step['calculations'], column_types)
+        return df
+
+if __name__ == "__main__":
+    pipeline = LazyPipeline('df_agg/df.csv', config)
+    print(pipeline.explain())
+    try:
+        print(pipeline.collect().head())
+    except (TypeError, ValueError) as e:
+        print(f"Error in configuration: {e}")
@@ -0,0 +1,120 @@
+import glob
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from df_agg5 import check_aggregations, config, finish_dataframe
+from df_agg_lazy import PARQUET_EXTENSIONS, LazyPipeline
+
+# How each aggregation is split into partial aggregates that can be combined
+# across partitions, and how the partials are combined
+PARTIAL_AGGREGATIONS = {'sum': ['sum'], 'count': ['count'], 'min': ['min'], 'max': ['max'], 'mean': ['sum', 'count']}
+COMBINE = {'sum': 'sum', 'count': 'sum', 'min': 'min', 'max': 'max', 'size': 'sum'}
+
+# A median cannot be rebuilt from per-partition summaries. 'exact' sends the
+# filtered values of median columns from every partition to the merge.
+MEDIAN_STRATEGIES = ('exact',)
+
+def _partial_name(column, func):
+    return f'{column}__{func}'
+
+def check_partial_aggregations(groupby_config, median):
+    for column, agg_func in groupby_config['aggregations'].items():
+        if agg_func == 'median':
+            if median not in MEDIAN_STRATEGIES:
+                raise ValueError(f"Unsupported median strategy '{median}', use one of {MEDIAN_STRATEGIES}")
+        elif agg_func not in PARTIAL_AGGREGATIONS:
+            raise ValueError(f"Aggregation '{agg_func}' on column '{column}' cannot be merged across partitions")
+
+# Function to aggregate one partition into partial aggregates. Returns the
+# partials per group, and the rows of median columns (or None).
+def partial_aggregate(df, groupby_config, median='exact'):
+    check_aggregations(df, groupby_config)
+    keys = groupby_config['groupby_columns']
+    named = {_partial_name('_group', 'size'): (keys[0], 'size')}  # keeps every group, even with only medians
+    median_columns = []
+    for column, agg_func in groupby_config['aggregations'].items():
+        if agg_func == 'median':
+            median_columns.append(column)
+            continue
+        for func in PARTIAL_AGGREGATIONS[agg_func]:
+            named[_partial_name(column, func)] = (column, func)
+    partials = df.groupby(keys).agg(**named)
+    values = df[keys + median_columns] if median_columns else None
+    return partials, values
+
+# Function to combine partial aggregate frames into one row per group
+def combine_partials(partials, keys):
+    partials = pd.concat(partials)
+    combine = {name: COMBINE[name.rsplit('__', 1)[1]] for name in partials.columns}
+    return partials.groupby(level=keys).agg(combine)
+
+# Function to build the final aggregates from combined partials. quantiles
+# holds the already computed median (or other quantile) columns per group.
+def finish_aggregates(merged, groupby_config, quantiles=None):
+    result = pd.DataFrame(index=merged.index)
+    for column, agg_func in groupby_config['aggregations'].items():
+        if agg_func == 'mean':
+            result[column] = merged[_partial_name(column, 'sum')] / merged[_partial_name(column, 'count')]
+        elif agg_func in PARTIAL_AGGREGATIONS:
+            result[column] = merged[_partial_name(column, agg_func)]
+        else:
+            result[column] = quantiles[column]
+    return result
+
+# Function to combine the partial aggregates of all partitions into the
+# result groupby_and_aggregate would give on the whole data
+def merge_partials(results, groupby_config):
+    keys = groupby_config['groupby_columns']
+    merged = combine_partials([partial for partial, _ in results], keys)
+    values = [rows for _, rows in results if rows is not None]
+    medians = pd.concat(values).groupby(keys).median() if values else None
+    return finish_aggregates(merged, groupby_config, medians)
+
+# Function to list the CSV and Parquet files of a partitioned dataset: a
+# directory (searched recursively), a glob pattern or a list of paths
+def partition_paths(source):
+    if isinstance(source, (list, tuple)):
+        return list(source)
+    if os.path.isdir(source):
+        paths = glob.glob(os.path.join(source, '**', '*'), recursive=True)
+        return sorted(path for path in paths if os.path.isfile(path)
+                      and os.path.splitext(path)[1].lower() in ('.csv',) + PARQUET_EXTENSIONS)
+    return sorted(glob.glob(source))
+
+# Function to filter and partially aggregate one partition file
+def aggregate_partition(path, config, median='exact'):
+    scanned = LazyPipeline(path, config).scan()
+    return partial_aggregate(scanned, config['groupby'], median)
+
+# Function to run the filter -> groupby -> calculate config over a partitioned
+# dataset (e.g. one file per ASOF_DATE and BUSINESS). Each partition is read,
+# filtered and partially aggregated on its own, on a process pool when
+# workers > 1; the partials are merged and the calculations, which may depend
+# on row order (like pct_change), run once on the merged result.
+def run_partitioned(source, config, workers=None, median='exact'):
+    groupby = config['groupby']
+    check_partial_aggregations(groupby, median)
+    paths = partition_paths(source)
+    if not paths:
+        raise ValueError(f"No partition files found in {source}")
+    if workers and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(aggregate_partition, paths, [config] * len(paths), [median] * len(paths)))
+    else:
+        results = [aggregate_partition(path, config, median) for path in paths]
+    merged = merge_partials(results, groupby)
+    return finish_dataframe(merged, config)
+
+if __name__ == "__main__":
+    # Split the sample into one file per BUSINESS and ASOF_DATE month, then run the config over them
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    df = pd.read_csv('df_agg/df.csv')
+    directory = tempfile.mkdtemp(prefix='df_agg_partitions_')
+    for (business, month), part in df.groupby(['BUSINESS', df['ASOF_DATE'].str.split('/').str[0]]):
+        part.to_csv(os.path.join(directory, f'{business}_{month}.csv'), index=False)
+    try:
+        print(run_partitioned(directory, config, workers).head())
+    except (TypeError, ValueError) as e:
+        print(f"Error in configuration: {e}")
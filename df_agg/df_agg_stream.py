@@ -0,0 +1,133 @@
+import re
+import sys
+import numpy as np
+import pandas as pd
+from df_agg5 import check_aggregations, config, finish_dataframe, is_numeric_type
+from df_agg_lazy import LazyPipeline
+from df_agg_parallel import PARTIAL_AGGREGATIONS, combine_partials, finish_aggregates, partial_aggregate
+
+# Mergeable summary of a stream of numbers for approximate quantiles, in
+# the style of a KLL sketch: values are kept in levels where an item of
+# level i stands for 2**i original values. When a level holds more than
+# capacity items it is sorted and every other item is promoted to the next
+# level, so memory stays O(capacity * log(n / capacity)) however many values
+# are added. While nothing has been compacted the quantiles are exact.
+class QuantileSketch:
+    def __init__(self, capacity=200):
+        self.capacity = capacity
+        self.levels = [np.empty(0)]
+        self.count = 0
+        self._offset = 0  # alternates which half of a level is promoted, to avoid bias
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if len(values):
+            self.levels[0] = np.concatenate([self.levels[0], values])
+            self.count += len(values)
+            self._compact()
+
+    def merge(self, other):
+        for level, items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.count += other.count
+        self._compact()
+
+    def _compact(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self.capacity:
+                items = np.sort(items)
+                kept = items[-1:] if len(items) % 2 else items[:0]
+                paired = items[:len(items) - len(kept)]
+                promoted = paired[self._offset::2]
+                self._offset ^= 1
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+                self.levels[level] = kept
+            level += 1
+
+    def quantile(self, q):
+        if self.count == 0:
+            return np.nan
+        if len(self.levels) == 1:
+            return float(np.quantile(self.levels[0], q))
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 2.0 ** level) for level, items in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        cumulative = np.cumsum(weights[order])
+        position = np.searchsorted(cumulative, q * cumulative[-1], side='left')
+        return float(values[order][min(position, len(values) - 1)])
+
+# Function to get the quantile an aggregation name asks for: 'median' or
+# 'pNN' (e.g. 'p90'); None for other aggregations
+def quantile_of(agg_func):
+    if agg_func == 'median':
+        return 0.5
+    match = re.fullmatch(r'p(\d{1,2}(?:\.\d+)?)', agg_func)
+    return float(match.group(1)) / 100 if match else None
+
+def _group_key(key):
+    return key if isinstance(key, tuple) else (key,)
+
+# Function to aggregate a CSV or Parquet file far larger than memory. The
+# file is read and filtered chunk by chunk; per group it keeps running
+# sum / count / min / max partials (mean is finished from sum and count) and
+# a QuantileSketch per median / pNN column, so memory grows with the number
+# of groups and not with the number of rows. Calculations run on the result.
+def stream_aggregate(path, config, chunk_rows=1_000_000, sketch_capacity=200):
+    groupby = config['groupby']
+    keys = groupby['groupby_columns']
+    quantiles = {}
+    for column, agg_func in groupby['aggregations'].items():
+        if quantile_of(agg_func) is not None:
+            quantiles[column] = quantile_of(agg_func)
+        elif agg_func not in PARTIAL_AGGREGATIONS:
+            raise ValueError(f"Aggregation '{agg_func}' on column '{column}' is not supported when streaming")
+    summary = {'groupby_columns': keys,
+               'aggregations': {column: agg_func for column, agg_func in groupby['aggregations'].items()
+                                if column not in quantiles}}
+
+    running = None
+    sketches = {column: {} for column in quantiles}
+    for chunk in LazyPipeline(path, config, chunk_rows).iter_scan():
+        if chunk.empty:
+            continue
+        check_aggregations(chunk, summary)
+        partials, _ = partial_aggregate(chunk, summary)
+        running = partials if running is None else combine_partials([running, partials], keys)
+        if quantiles:
+            groups = chunk.groupby(keys, sort=False).indices
+            for column in quantiles:
+                if not is_numeric_type(chunk[column].dtype):
+                    agg_func = groupby['aggregations'][column]
+                    raise TypeError(f"Invalid type for aggregation '{agg_func}' on column '{column}'")
+                values = chunk[column].to_numpy(dtype=float)
+                column_sketches = sketches[column]
+                for key, positions in groups.items():
+                    key = _group_key(key)
+                    if key not in column_sketches:
+                        column_sketches[key] = QuantileSketch(sketch_capacity)
+                    column_sketches[key].update(values[positions])
+    if running is None:
+        raise ValueError(f"No rows in {path} pass the filter")
+
+    estimates = pd.DataFrame(index=running.index)
+    for column, q in quantiles.items():
+        column_sketches = sketches[column]
+        estimates[column] = [column_sketches[_group_key(key)].quantile(q) if _group_key(key) in column_sketches
+                             else np.nan for key in running.index]
+    result = finish_aggregates(running, groupby, estimates)
+    return finish_dataframe(result, config)
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else 'df_agg/df.csv'
+    chunk_rows = int(sys.argv[2]) if len(sys.argv) > 2 else 1_000_000
+    try:
+        print(stream_aggregate(path, config, chunk_rows).head())
+    except (TypeError, ValueError) as e:
+        print(f"Error in configuration: {e}")
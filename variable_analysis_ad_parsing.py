@@ -1,8 +1,13 @@
 import pandas as pd
-import re
 import networkx as nx
 import matplotlib.pyplot as plt
 from collections import defaultdict
+from contextlib import nullcontext
+from variable_analysis_engine import (ancestors, compile_formulas, evaluate_matrix, evaluate_model, evaluate_parallel,
+                                      load_compiled_model)
+from variable_analysis_cache import ResultCache, evaluate_cached
+from variable_analysis_io import read_matrix, write_matrix
+from variable_analysis_profiler import Profiler, profile_phase
 
 # Function to read input data
 def read_input_data(file_path):
@@ -16,51 +21,8 @@ def read_input_data(file_path):
 
 # Function to parse formulas with advanced parsing
 def parse_formulas(formulas_str):
-    dependency_graph = defaultdict(list)
-    formulas = {}
-    
-    # Define patterns for operators and functions
-    operator_pattern = r'[\+\-\*\/]'
-    function_pattern = r'\b(?:lag|diff|ret)\(([^)]+)\)'
-    variable_pattern = r'\b(x\d+)\b'
-
-    for line in formulas_str.strip().split('\n'):
-        parts = line.split('=')
-        if len(parts) == 2:
-            var, formula = parts
-            # Identify dependencies by extracting variables from formulas
-            variables_in_formula = re.findall(variable_pattern, formula)
-            function_args = re.findall(function_pattern, formula)
-            for arg in function_args:
-                variables_in_formula.extend(re.findall(variable_pattern, arg))
-            
-            # Remove duplicates and the variable itself from dependencies
-            unique_dependencies = list(set(variables_in_formula) - {var.strip()})
-            dependency_graph[var.strip()] = unique_dependencies
-            formulas[var.strip()] = formula.strip()
-
-    return dependency_graph, formulas
-
-    dependency_graph = defaultdict(list)
-    formulas = {}
-    
-    # Define patterns for operators and functions
-    operator_pattern = r'[\+\-\*\/]'
-    function_pattern = r'\b(?:lag|diff|ret)\([^\)]+\)'
-
-    for line in formulas_str.strip().split('\n'):
-        parts = line.split('=')
-        if len(parts) == 2:
-            var, formula = parts
-            # Identify dependencies by splitting based on operators and functions
-            potential_vars = re.split(operator_pattern, formula)
-            potential_vars = [re.sub(function_pattern, '', var) for var in potential_vars]
-            dependencies = [var.strip() for var in potential_vars if var.strip() and var.strip() != var]
-
-            dependency_graph[var.strip()] = dependencies
-            formulas[var.strip()] = formula.strip()
-
-    return dependency_graph, formulas
+    model = compile_formulas(formulas_str)
+    return defaultdict(list, model.dependency_graph), model.formulas
 
 # Calculation functions
 def lag(series, n):
@@ -72,45 +34,11 @@ def diff(series):
 def ret(series):
     return series.pct_change()
 
-def evaluate_formula(formula, data):
-    for var in re.findall(r'x\d+', formula):
-        formula = formula.replace(var, f'data["{var}"]')
-    try:
-        return eval(formula)
-    except Exception as e:
-        print(f"Error evaluating formula {formula}: {e}")
-        return None
+FUNCTIONS = {'lag': lag, 'diff': diff, 'ret': ret}
 
 # Function to evaluate dependencies with corrected overlay data application
-def evaluate_dependencies_corrected(dependency_graph, data, formulas, overlay_data):
-    calculated_values = {}
-    
-    def calculate_variable(var):
-        if var in calculated_values:  # Already calculated
-            return calculated_values[var]
-        if var in overlay_data:  # Overlay data has priority
-            calculated_values[var] = overlay_data[var]
-            return overlay_data[var]
-        if var in data:  # Base data
-            return data[var]
-        
-        if var in formulas:
-            formula = formulas[var]
-            for dependency in dependency_graph[var]:
-                if dependency not in calculated_values:
-                    calculate_variable(dependency)
-
-            calculated_values[var] = evaluate_formula(formula, {**data, **calculated_values})
-        else:
-            print(f"Formula for {var} not found")
-            calculated_values[var] = pd.Series(dtype=float)
-
-        return calculated_values[var]
-
-    for variable in dependency_graph:
-        calculate_variable(variable)
-    
-    return {**data, **calculated_values}
+def evaluate_dependencies_corrected(model, data, overlay_data, profiler=None):
+    return evaluate_model(model, data, overlay_data, FUNCTIONS, profiler)
 
 # Function to visualize the dependency graph
 def visualize_dependency_graph(dependency_graph):
@@ -129,30 +57,78 @@ def visualize_dependency_graph(dependency_graph):
     plt.show()
 
 # Main function to run the analysis
-def main(input_csv_path, formulas_txt_path, overlay_csv_path):
-    input_data = read_input_data(input_csv_path)
-    overlay_data = read_input_data(overlay_csv_path)
-    with open(formulas_txt_path, 'r') as file:
-        formulas_content = file.read()
-
-    dependency_graph, formulas = parse_formulas(formulas_content)
-    all_variable_values = evaluate_dependencies_corrected(dependency_graph, input_data, formulas, overlay_data)
+# engine='matrix' keeps all variables as rows of one NumPy matrix instead of a dict of Series,
+# engine='thread' or 'process' evaluates that matrix level by level on a worker pool.
+# cache_dir keeps computed variables on disk, so reruns only compute what changed.
+# Inputs may be CSV, Parquet, Arrow IPC or .npy; with output_path the result is
+# written to disk in the same variables x time layout and the path is returned.
+# An optional Profiler records phase and per-formula timings.
+# With targets only those variables and what they depend on are parsed, read and
+# evaluated, and only the targets are returned. Repeated sub-expressions are
+# computed once, in hidden nodes that are left out of the result.
+def main(input_csv_path, formulas_txt_path, overlay_csv_path, engine='series', cache_dir=None, output_path=None,
+         profiler=None, targets=None):
+    with profile_phase(profiler, 'parse'):
+        model = load_compiled_model(formulas_txt_path, targets=targets, cse=True)
+    dependency_graph = model.dependency_graph
+    needed = ancestors(dependency_graph, targets) if targets is not None else None
+    if engine == 'series' and (cache_dir is not None or output_path is not None or targets is not None
+                               or not str(input_csv_path).lower().endswith('.csv')):
+        engine = 'matrix'
+    if engine in ('matrix', 'thread', 'process'):
+        with profile_phase(profiler, 'load'):
+            input_data = read_matrix(input_csv_path, needed)
+            overlay_data = read_matrix(overlay_csv_path, needed)
+        with profile_phase(profiler, 'evaluate'):
+            if cache_dir is not None:
+                result = evaluate_cached(model, input_data, ResultCache(cache_dir), overlay_data)
+            elif engine == 'matrix':
+                result = evaluate_matrix(model, input_data, overlay_data, profiler=profiler)
+            else:
+                result = evaluate_parallel(model, input_data, overlay_data, executor=engine)
+    else:
+        with profile_phase(profiler, 'load'):
+            input_data = read_input_data(input_csv_path)
+            overlay_data = read_input_data(overlay_csv_path)
+        with profile_phase(profiler, 'evaluate'):
+            all_variable_values = evaluate_dependencies_corrected(model, input_data, overlay_data, profiler)
 
     # Visualize the dependency graph
     visualize_dependency_graph(dependency_graph)
 
     print(dependency_graph)
 
-    return pd.DataFrame.from_dict(all_variable_values)
+    if targets is not None:
+        result = result.select(targets)
+    elif engine != 'series' and model.hidden:
+        result = result.select(model.visible(result.names))
+    if output_path is not None:
+        with profile_phase(profiler, 'write'):
+            return write_matrix(result, output_path)
+    if engine != 'series':
+        return result.to_frame()
+    return pd.DataFrame.from_dict({var: values for var, values in all_variable_values.items()
+                                   if var not in model.hidden})
 
 if __name__ == "__main__":
     import sys
 
     if len(sys.argv) < 4:
-        print("Usage: python script.py <input_csv_path> <formulas_txt_path> <overlay_csv_path>")
+        print("Usage: python script.py <input_csv_path> <formulas_txt_path> <overlay_csv_path> "
+              "[series|matrix|thread|process] [cache_dir|-] [output_path|-] [profile_json_path|-] [targets]")
     else:
         input_csv_path = sys.argv[1]
         formulas_txt_path = sys.argv[2]
         overlay_csv_path = sys.argv[3]
-        result = main(input_csv_path, formulas_txt_path, overlay_csv_path)
-        print(result)
\ No newline at end of file
+        engine = sys.argv[4] if len(sys.argv) > 4 else 'series'
+        cache_dir = sys.argv[5] if len(sys.argv) > 5 and sys.argv[5] != '-' else None
+        output_path = sys.argv[6] if len(sys.argv) > 6 and sys.argv[6] != '-' else None
+        profile_path = sys.argv[7] if len(sys.argv) > 7 and sys.argv[7] != '-' else None
+        targets = sys.argv[8].split(',') if len(sys.argv) > 8 else None
+        with Profiler(track_allocations=True) if profile_path else nullcontext() as profiler:
+            result = main(input_csv_path, formulas_txt_path, overlay_csv_path, engine, cache_dir, output_path,
+                          profiler, targets)
+        print(result)
+        if profiler is not None:
+            profiler.to_json(profile_path, load_compiled_model(formulas_txt_path, targets=targets, cse=True))
+            profiler.to_chrome_trace(profile_path.rsplit('.', 1)[0] + '.trace.json')
\ No newline at end of file
@@ -0,0 +1,172 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from variable_analysis_engine import MatrixData, compile_formulas, evaluate_matrix, evaluate_model, read_input_matrix
+from variable_analysis_io import write_matrix
+
+DEFAULT_MIX = {'plain': 2, 'lag': 1, 'diff': 1, 'ret': 1}
+
+
+# Function to generate a synthetic formulas.txt / input_variable.csv pair.
+# Formulas are spread over `depth` levels; each one combines `fan_in` operands
+# from earlier levels (at least one from the level just below), each operand
+# wrapped in lag/diff/ret or used as is according to `mix`.
+def generate_synthetic_model(n_inputs=100, n_formulas=1000, depth=5, fan_in=3, history=10, mix=None, seed=0):
+    rng = random.Random(seed)
+    mix = DEFAULT_MIX if mix is None else mix
+    kinds, weights = list(mix), list(mix.values())
+
+    inputs = [f'x{i}' for i in range(1, n_inputs + 1)]
+    levels = [inputs]
+    per_level = max(1, n_formulas // depth)
+    lines, number = [], n_inputs
+    for level in range(1, depth + 1):
+        count = per_level if level < depth else n_formulas - per_level * (depth - 1)
+        current = []
+        earlier = [var for previous in levels for var in previous]
+        for _ in range(max(0, count)):
+            number += 1
+            operands = [rng.choice(levels[-1])] + [rng.choice(earlier) for _ in range(fan_in - 1)]
+            terms = []
+            for operand in operands:
+                kind = rng.choices(kinds, weights)[0]
+                if kind == 'lag':
+                    terms.append(f'lag({operand},{rng.randint(1, 3)})')
+                elif kind in ('diff', 'ret'):
+                    terms.append(f'{kind}({operand})')
+                else:
+                    terms.append(operand)
+            formula = terms[0]
+            for term in terms[1:]:
+                formula += rng.choice(['+', '-', '*0.5+']) + term
+            lines.append(f'x{number}={formula}')
+            current.append(f'x{number}')
+        if current:
+            levels.append(current)
+
+    values = np.random.default_rng(seed).uniform(1.0, 2.0, size=(n_inputs, history))
+    data = MatrixData(values, inputs, [f't{i}' for i in range(1, history + 1)])
+    return '\n'.join(lines), data
+
+# Function to write a synthetic model to formulas.txt and input_variable.csv in directory
+def write_synthetic_model(directory, **options):
+    formulas_str, data = generate_synthetic_model(**options)
+    os.makedirs(directory, exist_ok=True)
+    formulas_path = os.path.join(directory, 'formulas.txt')
+    input_path = os.path.join(directory, 'input_variable.csv')
+    with open(formulas_path, 'w') as file:
+        file.write(formulas_str)
+    write_matrix(data, input_path)
+    return formulas_path, input_path
+
+
+def _time(step, repeat):
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = step()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def _peak_memory(step):
+    tracemalloc.start()
+    try:
+        step()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+# Function to time parsing, loading, evaluation and writing of a model
+# separately (best of `repeat`), and record the peak memory of each step
+def run_benchmark(formulas_path, input_path, engines=('series', 'matrix'), repeat=3):
+    with open(formulas_path) as file:
+        formulas_str = file.read()
+    model = compile_formulas(formulas_str)
+    matrix_data = read_input_matrix(input_path)
+    steps = {
+        'parse': lambda: compile_formulas(formulas_str),
+        'load_matrix': lambda: read_input_matrix(input_path),
+        'load_series': lambda: pd.read_csv(input_path).set_index('variable_name').T.to_dict('series'),
+    }
+    if 'series' in engines:
+        series_data = steps['load_series']()
+        steps['evaluate_series'] = lambda: evaluate_model(model, series_data)
+    if 'matrix' in engines:
+        steps['evaluate_matrix'] = lambda: evaluate_matrix(model, matrix_data)
+    output_path = os.path.join(tempfile.mkdtemp(), 'output.npy')
+    result = evaluate_matrix(model, matrix_data)
+    steps['write'] = lambda: write_matrix(result, output_path)
+
+    report = {'model': {'formulas': len(model.formulas), 'inputs': len(model.inputs),
+                        'depth': max(model.levels.values(), default=0), 'history': len(matrix_data.columns)},
+              'seconds': {}, 'peak_bytes': {}}
+    for name, step in steps.items():
+        report['seconds'][name], _ = _time(step, repeat)
+        report['peak_bytes'][name] = _peak_memory(step)
+    report['checksum'] = float(np.nansum(result.matrix))
+    return report
+
+# Function to compare a report with a stored baseline. A step regresses when
+# it is slower than the baseline by more than `tolerance` (0.2 = 20%) and by
+# more than min_delta seconds, so timer noise on tiny steps is ignored.
+def compare_with_baseline(report, baseline, tolerance=0.2, min_delta=0.005):
+    regressions = []
+    for name, seconds in report['seconds'].items():
+        reference = baseline.get('seconds', {}).get(name)
+        if reference and seconds > reference * (1 + tolerance) and seconds - reference > min_delta:
+            regressions.append(f"{name}: {seconds:.4f}s vs baseline {reference:.4f}s")
+    checksum = baseline.get('checksum')
+    if checksum is not None and not np.isclose(report['checksum'], checksum, rtol=1e-9, equal_nan=True):
+        regressions.append(f"checksum: {report['checksum']!r} vs baseline {checksum!r}")
+    return regressions
+
+
+def _parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        kind, weight = part.split('=')
+        mix[kind.strip()] = float(weight)
+    return mix
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the variable analysis formula engine")
+    parser.add_argument('--inputs', type=int, default=100)
+    parser.add_argument('--variables', type=int, default=1000, help="number of formulas")
+    parser.add_argument('--depth', type=int, default=5)
+    parser.add_argument('--fan-in', type=int, default=3)
+    parser.add_argument('--history', type=int, default=10)
+    parser.add_argument('--mix', type=_parse_mix, default=DEFAULT_MIX, help="e.g. plain=2,lag=1,diff=1,ret=1")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--engines', default='series,matrix')
+    parser.add_argument('--directory', default=None, help="where to write the synthetic model")
+    parser.add_argument('--baseline', default=None, help="baseline JSON to compare against")
+    parser.add_argument('--save-baseline', action='store_true', help="write this run to --baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    directory = args.directory or tempfile.mkdtemp(prefix='variable_analysis_benchmark_')
+    formulas_path, input_path = write_synthetic_model(
+        directory, n_inputs=args.inputs, n_formulas=args.variables, depth=args.depth, fan_in=args.fan_in,
+        history=args.history, mix=args.mix, seed=args.seed)
+    report = run_benchmark(formulas_path, input_path, tuple(args.engines.split(',')), args.repeat)
+    print(json.dumps(report, indent=2))
+
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(report, file, indent=2)
+    elif args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare_with_baseline(report, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,129 @@
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+from variable_analysis_engine import MATRIX_FUNCTIONS, evaluate_targets, function_globals, prepare_matrix
+
+
+# On-disk store of computed variable rows keyed by content hash, one .npy
+# file per entry. Reads refresh the file's mtime, and the least recently
+# used entries are evicted once the cache grows beyond max_bytes.
+class ResultCache:
+    def __init__(self, directory, max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(os.path.getsize(path) for path, _ in self._entries())
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f'{key}.npy')
+
+    def _entries(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.npy'):
+                    path = os.path.join(root, name)
+                    try:
+                        yield path, os.stat(path).st_mtime
+                    except FileNotFoundError:
+                        continue
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            values = np.load(path)
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        return values
+
+    def put(self, key, values):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so a crash never leaves a partial entry
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            np.save(file, values)
+        os.replace(temp_path, path)
+        self.size += os.path.getsize(path)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    # Function to delete least recently used entries until the cache fits
+    # (down to 90% of max_bytes, so eviction does not rescan on every put)
+    def evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        self.size = sum(os.path.getsize(path) for path, _ in entries)
+        for path, _ in entries:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                self.size -= size
+            except FileNotFoundError:
+                continue
+
+    def clear(self):
+        for path, _ in list(self._entries()):
+            os.remove(path)
+        self.size = 0
+
+
+def _hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+# Function to identify a function table, so changing e.g. diff invalidates the cache
+def functions_tag(functions):
+    return _hash(*(f'{name}={function.__module__}.{function.__qualname__}'
+                   for name, function in sorted(functions.items())))
+
+# Function to compute the cache key of every variable. Input and overlay rows
+# are keyed by the hash of their values; a formula is keyed by its source and
+# the keys of its dependencies, so keys are known before anything is computed.
+def variable_keys(model, result, pinned, functions):
+    columns = _hash(*result.columns)
+    tag = functions_tag(functions)
+    keys = {}
+    for var in model.inputs + [var for var in model.order if var in pinned]:
+        if var in pinned:
+            keys[var] = _hash('value', columns, np.ascontiguousarray(result.row(var)).tobytes())
+        else:
+            keys[var] = _hash('missing', columns, var)
+    for var in model.order:
+        if var not in keys:
+            keys[var] = _hash('formula', tag, model.formulas[var], *(keys[dep] for dep in model.dependencies[var]))
+    return keys
+
+# Function to evaluate a model with a ResultCache: cached variables are loaded,
+# the rest are evaluated (batched) and stored as soon as they are computed, so
+# a rerun after a crash resumes from what was already written.
+def evaluate_cached(model, data, cache, overlay_data=None, functions=None):
+    functions = MATRIX_FUNCTIONS if functions is None else functions
+    result, pinned = prepare_matrix(model, data, overlay_data)
+    matrix, index = result.matrix, result.index
+    keys = variable_keys(model, result, pinned, functions)
+
+    done = set(pinned)
+    for var in model.order:
+        if var in done:
+            continue
+        values = cache.get(keys[var])
+        if values is not None and values.shape == matrix[index[var]].shape:
+            matrix[index[var]] = values
+            done.add(var)
+
+    globals_ = function_globals(functions)
+    namespace = {name: matrix[row] for name, row in index.items()}
+    for shape, variables in model.batches:
+        targets = [var for var in variables if var not in done]
+        evaluate_targets(model, shape, targets, matrix, index, namespace, globals_)
+        for var in targets:
+            cache.put(keys[var], matrix[index[var]])
+    return result
@@ -0,0 +1,902 @@
+import ast
+import copy
+import hashlib
+import heapq
+import io
+import marshal
+import math
+import os
+import pickle
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+# Functions that may be called from a formula
+FUNCTION_NAMES = ('lag', 'diff', 'ret')
+
+# AST node types a formula is allowed to contain
+_ALLOWED_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Load,
+                  ast.Constant, ast.operator, ast.unaryop)
+
+# Calculation functions used when evaluating on pandas Series
+def _series_lag(series, n):
+    return series.shift(n)
+
+def _series_diff(series):
+    return series.diff().abs()
+
+def _series_ret(series):
+    return series.pct_change()
+
+SERIES_FUNCTIONS = {'lag': _series_lag, 'diff': _series_diff, 'ret': _series_ret}
+
+# Calculation functions used when evaluating on rows of a float64 matrix.
+# They work along the last axis, so they accept one row or a stack of rows.
+def _matrix_lag(values, n):
+    values = np.asarray(values, dtype=float)
+    n = int(n)
+    result = np.full(values.shape, np.nan)
+    length = values.shape[-1] if values.ndim else 0
+    if abs(n) >= length:
+        return result
+    if n >= 0:
+        result[..., n:] = values[..., :length - n]
+    else:
+        result[..., :n] = values[..., -n:]
+    return result
+
+def _matrix_diff(values):
+    values = np.asarray(values, dtype=float)
+    result = np.full(values.shape, np.nan)
+    np.abs(values[..., 1:] - values[..., :-1], out=result[..., 1:])
+    return result
+
+def _matrix_ret(values):
+    values = np.asarray(values, dtype=float)
+    result = np.full(values.shape, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(values[..., 1:], values[..., :-1], out=result[..., 1:])
+    result[..., 1:] -= 1
+    return result
+
+MATRIX_FUNCTIONS = {'lag': _matrix_lag, 'diff': _matrix_diff, 'ret': _matrix_ret}
+
+
+# A set of formulas parsed once into ASTs and code objects, together with
+# the evaluation plan derived from them. Pickling keeps the code objects
+# (marshalled), so a cached model is evaluated again without any parsing.
+class CompiledModel:
+    def __init__(self, formulas, trees, dependencies, hidden=()):
+        self.formulas = formulas          # variable -> formula source
+        self.trees = trees                # variable -> ast.Expression
+        self.dependencies = dependencies  # variable -> list of referenced variables
+        self.hidden = set(hidden)         # shared sub-expression nodes, not part of the results
+        self.codes = {var: compile(tree, f'<formula {var}>', 'eval') for var, tree in trees.items()}
+        self.order = topological_order(dependencies)
+        self.levels = topological_levels(dependencies, self.order)
+        self.lookback = {var: formula_lookback(tree.body) for var, tree in trees.items()}
+        # the order of the result rows: the formulas' own order, as if nothing had been hoisted
+        self.outputs = topological_order(self.dependency_graph) if self.hidden else self.order
+        self._build_batches()
+
+    # Group formulas with the same shape at the same level, so each group
+    # is evaluated as one operation over stacked matrix rows
+    def _build_batches(self):
+        self.arguments = {}    # variable -> variables bound to the shape placeholders
+        self.shape_codes = {}  # shape -> code object over the placeholders
+        groups = {}
+        for var in self.order:
+            shape, self.arguments[var] = formula_shape(self.trees[var])
+            if shape not in self.shape_codes:
+                tree = shape_tree(self.trees[var], self.arguments[var])
+                self.shape_codes[shape] = compile(tree, '<formula shape>', 'eval')
+            groups.setdefault((self.levels[var], shape), []).append(var)
+        self.batches = [(shape, variables) for (level, shape), variables in
+                        sorted(groups.items(), key=lambda item: item[0][0])]
+
+    # The formulas' own dependencies, with hidden nodes replaced by what they reference
+    @property
+    def dependency_graph(self):
+        if not self.hidden:
+            return self.dependencies
+        graph = {}
+        for var in self.order:
+            deps = []
+            for dep in self.dependencies[var]:
+                for name in graph[dep] if dep in self.hidden else [dep]:
+                    if name not in deps:
+                        deps.append(name)
+            graph[var] = deps
+        return {var: graph[var] for var in self.formulas if var not in self.hidden}
+
+    @property
+    def inputs(self):
+        # Variables referenced by formulas but not defined by any of them
+        referenced = {dep for deps in self.dependencies.values() for dep in deps}
+        return sorted(referenced - set(self.formulas))
+
+    # Function to drop the hidden sub-expression nodes from a list of names
+    def visible(self, names):
+        return [name for name in names if name not in self.hidden]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('codes', 'shape_codes'):
+            state[key] = {name: marshal.dumps(code) for name, code in state[key].items()}
+        state['_python'] = sys.version_info[:2]
+        return state
+
+    def __setstate__(self, state):
+        python = state.pop('_python')
+        state.setdefault('hidden', set())
+        state.setdefault('outputs', state['order'])
+        self.__dict__.update(state)
+        if python == sys.version_info[:2]:
+            for key in ('codes', 'shape_codes'):
+                setattr(self, key, {name: marshal.loads(code) for name, code in state[key].items()})
+        else:
+            # marshal format is version specific, rebuild from the stored ASTs
+            self.codes = {var: compile(tree, f'<formula {var}>', 'eval') for var, tree in self.trees.items()}
+            self._build_batches()
+
+
+# Replaces variable names in a formula AST with positional placeholders
+class _ShapeTransformer(ast.NodeTransformer):
+    def __init__(self, arguments):
+        self.arguments = arguments
+
+    def visit_Call(self, node):
+        node.args = [self.visit(arg) for arg in node.args]
+        return node
+
+    def visit_Name(self, node):
+        return ast.copy_location(ast.Name(id=f'_v{self.arguments.index(node.id)}', ctx=ast.Load()), node)
+
+# Function to build a hashable key describing the structure of a formula AST,
+# collecting the variables in order of first appearance
+def _shape_key(node, arguments):
+    if isinstance(node, ast.Name):
+        if node.id not in arguments:
+            arguments.append(node.id)
+        return arguments.index(node.id)
+    if isinstance(node, ast.BinOp):
+        return (type(node.op).__name__, _shape_key(node.left, arguments), _shape_key(node.right, arguments))
+    if isinstance(node, ast.UnaryOp):
+        return (type(node.op).__name__, _shape_key(node.operand, arguments))
+    if isinstance(node, ast.Call):
+        return (node.func.id,) + tuple(_shape_key(arg, arguments) for arg in node.args)
+    return ('const', repr(node.value))
+
+# Function to reduce a formula to its shape: formulas that differ only in
+# their variables, e.g. x21 = ret(x4) + x5 and x22 = ret(x7) + x8, share a shape
+def formula_shape(tree):
+    arguments = []
+    return _shape_key(tree.body, arguments), arguments
+
+# Function to count how many past time points a formula reads, e.g.
+# lag(ret(x1), 2) needs 3. Returns None if it reads future points (negative
+# lag) or the lag is not a constant.
+def formula_lookback(node):
+    if isinstance(node, ast.BinOp):
+        left, right = formula_lookback(node.left), formula_lookback(node.right)
+        return None if left is None or right is None else max(left, right)
+    if isinstance(node, ast.UnaryOp):
+        return formula_lookback(node.operand)
+    if isinstance(node, ast.Call):
+        inner = formula_lookback(node.args[0]) if node.args else 0
+        if inner is None:
+            return None
+        if node.func.id != 'lag':
+            return inner + 1
+        try:
+            n = ast.literal_eval(node.args[1])
+        except (IndexError, ValueError):
+            return None
+        return inner + int(n) if isinstance(n, (int, float)) and n >= 0 else None
+    return 0
+
+# Function to build the placeholder AST for a shape from one of its formulas
+def shape_tree(tree, arguments):
+    return ast.fix_missing_locations(_ShapeTransformer(arguments).visit(copy.deepcopy(tree)))
+
+
+# Variables stored as rows of one contiguous float64 matrix (variables x time)
+class MatrixData:
+    def __init__(self, matrix, names, columns):
+        self.matrix = matrix
+        self.names = list(names)
+        self.columns = list(columns)
+        self.index = {name: row for row, name in enumerate(self.names)}
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def row(self, name):
+        return self.matrix[self.index[name]]
+
+    # Rows of the given variables (those present), in matrix order
+    def select(self, names):
+        rows = [self.index[name] for name in self.names if name in names]
+        return MatrixData(self.matrix[rows], [self.names[row] for row in rows], self.columns)
+
+    def reindex_columns(self, columns):
+        columns = list(columns)
+        if columns == self.columns:
+            return self
+        frame = pd.DataFrame(self.matrix, index=self.names, columns=self.columns).reindex(columns=columns)
+        return MatrixData(frame.to_numpy(dtype=np.float64), self.names, columns)
+
+    # Same layout as main's output: time points as rows, variables as columns
+    def to_frame(self):
+        return pd.DataFrame(self.matrix.T, index=self.columns, columns=self.names)
+
+    @classmethod
+    def from_frame(cls, df):
+        return cls(np.ascontiguousarray(df.to_numpy(dtype=np.float64)), df.index, df.columns)
+
+
+# Function to read input data as a variables x time matrix, without transposing.
+# round_trip parsing gives the exact same floats as the streaming reader.
+# With variables, only the rows of those variables are parsed.
+def read_input_matrix(file_path, variables=None):
+    try:
+        if variables is None:
+            df = pd.read_csv(file_path, float_precision='round_trip')
+        else:
+            with open(file_path, 'r') as file:
+                lines = [next(file, '')]
+                lines.extend(line for line in file if line.split(',', 1)[0].strip() in variables)
+            df = pd.read_csv(io.StringIO(''.join(lines)), float_precision='round_trip')
+        df.set_index('variable_name', inplace=True)
+        return MatrixData.from_frame(df)
+    except FileNotFoundError:
+        print(f"File not found: {file_path}")
+        return None
+
+
+# Function to order formula variables so every variable follows its dependencies.
+# Iterative (Kahn's algorithm), so deep chains do not hit the recursion limit.
+def topological_order(dependency_graph):
+    indegree = {var: 0 for var in dependency_graph}
+    dependents = {var: [] for var in dependency_graph}
+    for var, deps in dependency_graph.items():
+        for dep in set(deps):
+            if dep in dependency_graph and dep != var:
+                indegree[var] += 1
+                dependents[dep].append(var)
+
+    ready = deque(var for var, count in indegree.items() if count == 0)
+    order = []
+    while ready:
+        var = ready.popleft()
+        order.append(var)
+        for dependent in dependents[var]:
+            indegree[dependent] -= 1
+            if indegree[dependent] == 0:
+                ready.append(dependent)
+
+    if len(order) < len(indegree):
+        cycle = find_cycle(dependency_graph, {var for var, count in indegree.items() if count > 0})
+        raise ValueError(f"Circular dependency between formulas: {' -> '.join(cycle)}")
+    return order
+
+# Function to invert a dependency graph: variable -> formula variables using it
+def dependents_graph(dependency_graph):
+    dependents = {}
+    for var, deps in dependency_graph.items():
+        for dep in deps:
+            dependents.setdefault(dep, []).append(var)
+    return dependents
+
+# Function to assign each formula variable its depth in the dependency graph.
+# Variables at the same level never depend on each other.
+def topological_levels(dependency_graph, order):
+    levels = {}
+    for var in order:
+        levels[var] = 1 + max((levels[dep] for dep in dependency_graph[var] if dep in levels), default=0)
+    return levels
+
+# Function to find one cycle among the given unresolved variables
+def find_cycle(dependency_graph, unresolved):
+    # Every unresolved variable has an unresolved dependency, so walking
+    # dependencies from any of them must eventually revisit a variable.
+    var = next(iter(unresolved))
+    path, seen = [], {}
+    while var not in seen:
+        seen[var] = len(path)
+        path.append(var)
+        var = next(dep for dep in dependency_graph[var] if dep in unresolved and dep != var)
+    return path[seen[var]:] + [var]
+
+# Function to parse a single formula into a validated AST and its dependencies
+def parse_formula(var, formula):
+    try:
+        tree = ast.parse(formula, mode='eval')
+    except SyntaxError as e:
+        raise ValueError(f"Invalid formula for {var}: {formula} ({e.msg})")
+
+    dependencies = []
+    called = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, _ALLOWED_NODES):
+            raise ValueError(f"Unsupported syntax '{type(node).__name__}' in formula for {var}: {formula}")
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTION_NAMES or node.keywords:
+                raise ValueError(f"Unsupported function call in formula for {var}: {formula}")
+            called.add(id(node.func))
+        elif isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise ValueError(f"Unsupported constant {node.value!r} in formula for {var}: {formula}")
+        elif isinstance(node, ast.Name) and id(node) not in called:
+            # ast.walk is breadth first, so a call is always seen before its function name
+            if node.id in FUNCTION_NAMES:
+                raise ValueError(f"Function '{node.id}' used as a variable in formula for {var}: {formula}")
+            if node.id != var and node.id not in dependencies:
+                dependencies.append(node.id)
+    return tree, dependencies
+
+# Hidden nodes created by common sub-expression elimination are named
+# _cse0, _cse1, ... Only calls and operations on at least one variable are
+# shared; constants are cheaper to recompute than to store.
+CSE_PREFIX = '_cse'
+_CSE_NODES = (ast.BinOp, ast.UnaryOp, ast.Call)
+
+# Function to list the variables a formula AST references, in order of appearance
+def formula_names(node):
+    called = {id(child.func) for child in ast.walk(node) if isinstance(child, ast.Call)}
+    names = []
+    for child in ast.walk(node):
+        if isinstance(child, ast.Name) and id(child) not in called and child.id not in names:
+            names.append(child.id)
+    return names
+
+# Function to give every sub-expression of a tree a structural key, equal
+# keys meaning equal sub-expressions. Keys are interned in table so they stay
+# small integers. Fills keys (id(node) -> key) for the nodes that may be
+# shared by owner and returns the key and variables of node.
+def _subexpression_keys(owner, node, keys, table):
+    children = [_subexpression_keys(owner, child, keys, table) for child in ast.iter_child_nodes(node)]
+    if isinstance(node, ast.Name):
+        label, names = node.id, {node.id}
+    elif isinstance(node, ast.Constant):
+        label, names = repr(node.value), set()
+    else:
+        label = type(node).__name__
+        arguments = children[1:] if isinstance(node, ast.Call) else children  # skip the function name
+        names = set().union(*(child_names for _, child_names in arguments))
+    key = table.setdefault((label,) + tuple(child_key for child_key, _ in children), len(table))
+    if isinstance(node, _CSE_NODES) and names and owner not in names:
+        keys[id(node)] = key
+    return key, names
+
+# Function to replace shared sub-expressions with the names of their hidden
+# nodes, outermost first. New hidden nodes are added to definitions.
+def _hoist_subexpressions(owner, node, keys, repeated, hoisted, definitions, names):
+    key = keys.get(id(node))
+    if key is not None and hoisted.get(key) != owner and (key in hoisted or key in repeated):
+        if key not in hoisted:
+            name = f'{CSE_PREFIX}{len(hoisted)}'
+            while name in names:
+                name += '_'
+            hoisted[key] = name
+            definitions[name] = node
+        return ast.copy_location(ast.Name(id=hoisted[key], ctx=ast.Load()), node)
+    for field, value in ast.iter_fields(node):
+        if isinstance(value, ast.AST):
+            setattr(node, field, _hoist_subexpressions(owner, value, keys, repeated, hoisted, definitions, names))
+        elif isinstance(value, list):
+            value[:] = [_hoist_subexpressions(owner, item, keys, repeated, hoisted, definitions, names)
+                        if isinstance(item, ast.AST) else item for item in value]
+    return node
+
+# Function to hoist sub-expressions that occur more than once across the
+# formulas (e.g. ret(x4) or x1*2) into hidden nodes evaluated only once.
+# Repeated until no shared sub-expression is left, so sub-expressions nested
+# in a hoisted one are shared too. Trees are rewritten in place; returns the
+# formulas, trees and dependencies including the hidden nodes, and their names.
+def eliminate_common_subexpressions(formulas, trees, dependencies):
+    names = set(trees).union(*dependencies.values())
+    hoisted, table = {}, {}  # sub-expression key -> hidden node name, interned keys
+    while True:
+        keys, counts = {}, {}
+        hidden = set(hoisted.values())
+        for var, tree in trees.items():
+            _subexpression_keys(var, tree.body, keys, table)
+            if var in hidden:
+                keys.pop(id(tree.body), None)  # a hidden node's own definition
+        for key in keys.values():
+            counts[key] = counts.get(key, 0) + 1
+        repeated = {key for key, count in counts.items() if count > 1}
+        if not repeated:
+            break
+        definitions = {}
+        for var, tree in trees.items():
+            tree.body = _hoist_subexpressions(var, tree.body, keys, repeated, hoisted, definitions, names)
+        for name, node in definitions.items():
+            trees[name] = ast.Expression(body=node)
+        names.update(definitions)
+
+    formulas, dependencies = dict(formulas), {}
+    for var, tree in trees.items():
+        ast.fix_missing_locations(tree)
+        dependencies[var] = [name for name in formula_names(tree.body) if name != var]
+        if var in hidden:
+            formulas[var] = ast.unparse(tree.body)
+    return formulas, trees, dependencies, hidden
+
+# Function to split formulas text into (variable, formula) pairs
+def split_formula_lines(formulas_str):
+    for line in formulas_str.strip().split('\n'):
+        parts = line.split('=')
+        if len(parts) == 2:
+            var, formula = parts
+            yield var.strip(), formula.strip()
+
+# Function to compile formulas text into a CompiledModel. With targets, only
+# the formulas those variables (transitively) depend on are parsed. With
+# cse=True repeated sub-expressions are computed once, in hidden nodes.
+def compile_formulas(formulas_str, targets=None, cse=False):
+    lines = dict(split_formula_lines(formulas_str))
+    parsed = {}
+    pending = list(lines) if targets is None else list(targets)
+    while pending:
+        var = pending.pop()
+        if var in parsed or var not in lines:
+            continue
+        parsed[var] = parse_formula(var, lines[var])
+        if targets is not None:
+            pending.extend(parsed[var][1])
+
+    formulas, trees, dependencies = {}, {}, {}
+    for var in lines:
+        if var in parsed:
+            trees[var], dependencies[var] = parsed[var]
+            formulas[var] = lines[var]
+    if cse:
+        return CompiledModel(*eliminate_common_subexpressions(formulas, trees, dependencies))
+    return CompiledModel(formulas, trees, dependencies)
+
+# Function to find the targets and every variable they transitively depend on
+def ancestors(dependency_graph, targets):
+    needed, pending = set(), list(targets)
+    while pending:
+        var = pending.pop()
+        if var not in needed:
+            needed.add(var)
+            pending.extend(dependency_graph.get(var, ()))
+    return needed
+
+# Function to restrict a compiled model to the formulas the targets need
+def prune_model(model, targets):
+    needed = ancestors(model.dependencies, targets)
+    variables = [var for var in model.formulas if var in needed]
+    return CompiledModel({var: model.formulas[var] for var in variables}, {var: model.trees[var] for var in variables},
+                         {var: model.dependencies[var] for var in variables}, model.hidden & needed)
+
+
+_model_cache = {}
+
+# Function to load a compiled model, reusing the in-process and on-disk caches.
+# With targets the model only holds the formulas those variables need.
+def load_compiled_model(formulas_txt_path, cache_path=None, targets=None, cse=False):
+    with open(formulas_txt_path, 'r') as file:
+        formulas_content = file.read()
+    full_key = hashlib.sha256(formulas_content.encode()).hexdigest() + (':cse' if cse else '')
+    key = full_key if targets is None else f"{full_key}:{','.join(sorted(targets))}"
+    if key in _model_cache:
+        return _model_cache[key]
+    if targets is not None and full_key in _model_cache:
+        _model_cache[key] = prune_model(_model_cache[full_key], targets)
+        return _model_cache[key]
+
+    model = None
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'rb') as file:
+                cached_key, cached_model = pickle.load(file)
+            if cached_key == key:
+                model = cached_model
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError) as e:
+            print(f"Ignoring unreadable model cache {cache_path}: {e}")
+
+    if model is None:
+        model = compile_formulas(formulas_content, targets, cse)
+        if cache_path:
+            with open(cache_path, 'wb') as file:
+                pickle.dump((key, model), file)
+
+    _model_cache[key] = model
+    return model
+
+# Function to build the globals formulas are evaluated with
+def function_globals(functions=None):
+    globals_ = {'__builtins__': {}}
+    globals_.update(SERIES_FUNCTIONS if functions is None else functions)
+    return globals_
+
+# Function to evaluate one compiled formula against a namespace of values
+def evaluate_compiled(model, var, namespace, globals_):
+    try:
+        return eval(model.codes[var], globals_, namespace)
+    except Exception as e:
+        print(f"Error evaluating formula {var} = {model.formulas[var]}: {e}")
+        return None
+
+# Function to evaluate every formula in dependency order on one shared namespace.
+# Overlay values take priority over input data, which takes priority over formulas.
+def evaluate_model(model, data, overlay_data=None, functions=None, profiler=None):
+    namespace = dict(data)
+    if overlay_data:
+        namespace.update(overlay_data)
+    for var in model.inputs:
+        if var not in namespace:
+            print(f"Formula for {var} not found")
+            namespace[var] = pd.Series(dtype=float)
+
+    globals_ = function_globals(functions)
+    for var in model.order:
+        if var in namespace:
+            continue
+        if profiler is None:
+            namespace[var] = evaluate_compiled(model, var, namespace, globals_)
+        else:
+            namespace[var] = profiler.measure([var], lambda: evaluate_compiled(model, var, namespace, globals_))
+    return namespace
+
+# Function to evaluate every formula on rows of a single matrix.
+# Overlay rows take priority over input rows, which take priority over formulas.
+# With batch=True formulas of the same shape and level are evaluated together.
+# An optional variable_analysis_profiler.Profiler records per-formula costs.
+def evaluate_matrix(model, data, overlay_data=None, functions=None, batch=True, profiler=None):
+    result, pinned = prepare_matrix(model, data, overlay_data)
+    matrix, index = result.matrix, result.index
+    globals_ = function_globals(MATRIX_FUNCTIONS if functions is None else functions)
+    namespace = {name: matrix[row] for name, row in index.items()}
+    if batch:
+        steps = [(shape, [var for var in variables if var not in pinned]) for shape, variables in model.batches]
+    else:
+        steps = [(None, [var]) for var in model.order if var not in pinned]
+
+    for shape, targets in steps:
+        if profiler is None:
+            evaluate_targets(model, shape, targets, matrix, index, namespace, globals_)
+        elif targets:
+            profiler.measure(targets, lambda: evaluate_targets(model, shape, targets, matrix, index, namespace,
+                                                               globals_), matrix.shape[1] * matrix.itemsize)
+    return result
+
+# Function to order the matrix rows: inputs, extra overlay variables, inputs
+# missing from the data, formula variables, then hidden nodes. Pinned (input or overlay)
+# variables are never overwritten by formulas.
+def _matrix_layout(model, data_names, overlay_names):
+    names = list(data_names)
+    pinned = set(names)
+    for var in overlay_names:
+        if var not in pinned:
+            names.append(var)
+            pinned.add(var)
+    missing = [var for var in model.inputs if var not in pinned]
+    names.extend(missing)
+    names.extend(var for var in model.outputs if var not in pinned)
+    names.extend(var for var in model.order if var in model.hidden and var not in pinned)
+    return names, pinned, missing
+
+# Function to fill a matrix, optionally a preallocated buffer, with the input
+# and overlay rows. Every other row starts as NaN, so a formula reading its
+# own or a missing variable gets NaN rather than leftover memory.
+# Returns the MatrixData and the set of pinned variables.
+def prepare_matrix(model, data, overlay_data, buffer=None, report_missing=True):
+    if overlay_data is not None:
+        overlay_data = overlay_data.reindex_columns(data.columns)
+    names, pinned, missing = _matrix_layout(model, data.names, overlay_data.names if overlay_data is not None else [])
+    if buffer is None:
+        buffer = np.empty((len(names), len(data.columns)))
+    result = MatrixData(buffer, names, data.columns)
+    matrix, index = result.matrix, result.index
+    matrix[:len(data.names)] = data.matrix
+    matrix[len(data.names):] = np.nan
+    if overlay_data is not None:
+        matrix[[index[var] for var in overlay_data.names]] = overlay_data.matrix
+    if report_missing:
+        for var in missing:
+            print(f"Formula for {var} not found")
+    return result, pinned
+
+# Function to evaluate the given formulas of one shape, batched when there are several
+def evaluate_targets(model, shape, targets, matrix, index, namespace, globals_, offset=0):
+    if len(targets) == 1:
+        _evaluate_row(model, targets[0], matrix, index, namespace, globals_, offset)
+    elif targets:
+        _evaluate_batch(model, shape, targets, matrix, index, namespace, globals_, offset)
+
+# Function to write results into matrix rows. Only columns from offset onwards
+# are written; streaming uses this to keep the carried-over history intact.
+def _store(matrix, rows, value, offset):
+    if offset and np.ndim(value):
+        value = value[..., offset:]
+    matrix[rows, offset:] = value
+
+# Function to evaluate one formula into its matrix row
+def _evaluate_row(model, var, matrix, index, namespace, globals_, offset=0):
+    value = evaluate_compiled(model, var, namespace, globals_)
+    _store(matrix, index[var], np.nan if value is None else value, offset)
+
+# Function to evaluate formulas sharing a shape as one operation over stacked rows
+def _evaluate_batch(model, shape, targets, matrix, index, namespace, globals_, offset=0):
+    stacked = {}
+    for position in range(len(model.arguments[targets[0]])):
+        stacked[f'_v{position}'] = matrix[[index[model.arguments[var][position]] for var in targets]]
+    try:
+        value = eval(model.shape_codes[shape], globals_, stacked)
+    except Exception:
+        # Evaluate one by one so the failing formula is reported on its own
+        for var in targets:
+            _evaluate_row(model, var, matrix, index, namespace, globals_, offset)
+        return
+    _store(matrix, [index[var] for var in targets], value, offset)
+
+
+# Function to split each level of the evaluation plan into work units.
+# Large batches are cut into row chunks so a level spreads over all workers.
+def parallel_units(model, pinned, workers):
+    levels = {}
+    for shape, variables in model.batches:
+        targets = [var for var in variables if var not in pinned]
+        if targets:
+            levels.setdefault(model.levels[variables[0]], []).append((shape, targets))
+
+    plan = []
+    for level in sorted(levels):
+        items = levels[level]
+        chunk = max(1, math.ceil(sum(len(targets) for _, targets in items) / workers))
+        pieces = [(shape, targets[start:start + chunk]) for shape, targets in items
+                  for start in range(0, len(targets), chunk)]
+        # Greedily assign the largest pieces to the least loaded unit
+        units = [[] for _ in range(min(workers, len(pieces)))]
+        loads = [0] * len(units)
+        for shape, targets in sorted(pieces, key=lambda piece: -len(piece[1])):
+            smallest = loads.index(min(loads))
+            units[smallest].append((shape, targets))
+            loads[smallest] += len(targets)
+        plan.append(units)
+    return plan
+
+_worker_state = {}
+
+# Process pool initializer: attach to the shared matrix once per worker
+def _init_worker(model, shm_name, shape, names, functions):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    matrix = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    index = {name: row for row, name in enumerate(names)}
+    _worker_state.update(shm=shm, model=model, matrix=matrix, index=index,
+                         namespace={name: matrix[row] for name, row in index.items()},
+                         globals_=function_globals(functions))
+
+def _run_unit(unit, state=None):
+    state = _worker_state if state is None else state
+    for shape, targets in unit:
+        evaluate_targets(state['model'], shape, targets, state['matrix'], state['index'],
+                          state['namespace'], state['globals_'])
+
+# Function to evaluate the model level by level on a thread or process pool.
+# Formulas within a level are independent, so their work units run in
+# parallel. With executor='process' the matrix lives in shared memory and
+# workers write their rows in place instead of pickling values back.
+def evaluate_parallel(model, data, overlay_data=None, functions=None, executor='thread', max_workers=None):
+    functions = MATRIX_FUNCTIONS if functions is None else functions
+    workers = max_workers or os.cpu_count() or 1
+    if executor == 'thread':
+        result, pinned = prepare_matrix(model, data, overlay_data)
+        matrix, index = result.matrix, result.index
+        state = {'model': model, 'matrix': matrix, 'index': index, 'globals_': function_globals(functions),
+                 'namespace': {name: matrix[row] for name, row in index.items()}}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for units in parallel_units(model, pinned, workers):
+                list(pool.map(_run_unit, units, [state] * len(units)))
+        return result
+    if executor != 'process':
+        raise ValueError(f"Unsupported executor: {executor}")
+
+    names, _, _ = _matrix_layout(model, data.names, overlay_data.names if overlay_data is not None else [])
+    shape = (len(names), len(data.columns))
+    shm = shared_memory.SharedMemory(create=True, size=max(1, math.prod(shape) * 8))
+    try:
+        buffer = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+        result, pinned = prepare_matrix(model, data, overlay_data, buffer)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(model, shm.name, shape, result.names, functions)) as pool:
+            for units in parallel_units(model, pinned, workers):
+                list(pool.map(_run_unit, units))
+        result.matrix = buffer.copy()
+        del buffer
+    finally:
+        shm.close()
+        shm.unlink()
+    return result
+
+# Results of evaluating many overlay scenarios against one base input.
+# Only the variables some overlay affects are stored per scenario, as a
+# scenario x affected variable x time cube; everything else is shared
+# through the base result.
+class ScenarioResult:
+    def __init__(self, base, names, cube, affected):
+        self.base = base            # MatrixData evaluated without overlays
+        self.names = names          # variables stored in the cube
+        self.cube = cube            # scenarios x len(names) x time
+        self.affected = affected    # per scenario, the set of variables its overlay affects
+        self.index = {name: position for position, name in enumerate(names)}
+
+    def __len__(self):
+        return self.cube.shape[0]
+
+    def row(self, scenario, var):
+        if var in self.index:
+            return self.cube[scenario, self.index[var]]
+        return self.base.row(var)
+
+    # Full variables x time result of one scenario
+    def scenario(self, scenario):
+        matrix = self.base.matrix.copy()
+        matrix[[self.base.index[var] for var in self.names]] = self.cube[scenario]
+        return MatrixData(matrix, self.base.names, self.base.columns)
+
+    # Full scenario x variable x time array
+    def to_array(self):
+        array = np.broadcast_to(self.base.matrix, (len(self),) + self.base.matrix.shape).copy()
+        array[:, [self.base.index[var] for var in self.names]] = self.cube
+        return array
+
+
+# Function to evaluate a stack of overlay scenarios in one pass. The base
+# input is evaluated once; each formula an overlay affects is then evaluated
+# once for all scenarios it affects, over stacked (scenario x time) rows.
+def evaluate_scenarios(model, data, overlays, functions=None):
+    base = evaluate_matrix(model, data, None, functions)
+    overlays = [overlay.reindex_columns(data.columns) for overlay in overlays]
+    extra = sorted({var for overlay in overlays for var in overlay.names} - set(base.names))
+    if extra:
+        base = MatrixData(np.vstack([base.matrix, np.full((len(extra), len(base.columns)), np.nan)]),
+                          base.names + extra, base.columns)
+
+    dependents = dependents_graph(model.dependencies)
+    affected = []
+    for overlay in overlays:
+        reached = set(overlay.names)
+        stack = list(overlay.names)
+        while stack:
+            for dependent in dependents.get(stack.pop(), ()):
+                if dependent not in reached and dependent not in data:
+                    reached.add(dependent)
+                    stack.append(dependent)
+        affected.append(reached)
+
+    position = {var: position for position, var in enumerate(model.order)}
+    names = sorted(set().union(*affected), key=lambda var: (var in position, position.get(var, 0), var))
+    index = {name: row for row, name in enumerate(names)}
+    cube = np.empty((len(overlays), len(names), len(base.columns)))
+    cube[:] = base.matrix[[base.index[var] for var in names]]
+    for scenario, overlay in enumerate(overlays):
+        cube[scenario, [index[var] for var in overlay.names]] = overlay.matrix
+
+    globals_ = function_globals(MATRIX_FUNCTIONS if functions is None else functions)
+    for var in names:
+        if var not in position or var in data:
+            continue
+        scenarios = [scenario for scenario, overlay in enumerate(overlays)
+                     if var in affected[scenario] and var not in overlay]
+        if not scenarios:
+            continue
+        namespace = {}
+        for dep in model.dependencies[var]:
+            if dep in index:
+                namespace[dep] = cube[scenarios, index[dep]]
+            elif dep in base:
+                namespace[dep] = base.row(dep)
+        value = evaluate_compiled(model, var, namespace, globals_)
+        cube[scenarios, index[var]] = np.nan if value is None else value
+    return ScenarioResult(base, names, cube, affected)
+
+# Function to evaluate the model over successive time chunks of the input,
+# yielding one MatrixData per chunk. Each chunk is evaluated together with the
+# last values of the previous one (as many as the deepest lag/diff/ret chain
+# needs), so the results are identical to a single in-memory run. The
+# overlay is a whole MatrixData (overlays are small); each chunk gets its
+# columns by time label, NaN where the overlay has none.
+def evaluate_stream(model, chunks, overlay_data=None, functions=None):
+    unsupported = [var for var, lookback in model.lookback.items() if lookback is None]
+    if unsupported:
+        raise ValueError(f"Formulas read future values and cannot be streamed: {', '.join(unsupported)}")
+    history = max(model.lookback.values(), default=0)
+    globals_ = function_globals(MATRIX_FUNCTIONS if functions is None else functions)
+    overlay_names = overlay_data.names if overlay_data is not None else []
+
+    extended = None
+    for chunk in chunks:
+        previous = extended
+        names, _, _ = _matrix_layout(model, chunk.names, overlay_names)
+        extended = np.full((len(names), history + len(chunk.columns)), np.nan)
+        if previous is not None:
+            if previous.shape[0] != len(names):
+                raise ValueError("Every chunk must contain the same variables")
+            extended[:, :history] = previous[:, previous.shape[1] - history:]
+        current, pinned = prepare_matrix(model, chunk, overlay_data, extended[:, history:], previous is None)
+        index = current.index
+
+        namespace = {name: extended[row] for name, row in index.items()}
+        for shape, variables in model.batches:
+            targets = [var for var in variables if var not in pinned]
+            evaluate_targets(model, shape, targets, extended, index, namespace, globals_, history)
+        yield MatrixData(extended[:, history:].copy(), names, chunk.columns)
+
+# Keeps the results of a matrix evaluation and recomputes only the
+# descendants of inputs or overlays that change between runs.
+class IncrementalEvaluator:
+    def __init__(self, model, data, overlay_data=None, functions=None):
+        self.model = model
+        self.data = MatrixData(data.matrix.copy(), data.names, data.columns)
+        self.result = evaluate_matrix(model, data, overlay_data, functions)
+        self.overlaid = set(overlay_data.names) if overlay_data is not None else set()
+        self.dependents = dependents_graph(model.dependencies)
+        self.position = {var: position for position, var in enumerate(model.order)}
+        self.globals_ = function_globals(MATRIX_FUNCTIONS if functions is None else functions)
+        self.namespace = {name: self.result.matrix[row] for name, row in self.result.index.items()}
+
+    # Apply changed input rows and/or overlay rows, then recompute what they
+    # affect. Recomputed values equal to the previous ones are not propagated.
+    # Returns the set of variables whose values changed.
+    def update(self, inputs=None, overlay_data=None, cleared_overlays=()):
+        matrix, index = self.result.matrix, self.result.index
+        changed, recompute = set(), set()
+
+        def write(var, values):
+            if not np.array_equal(matrix[index[var]], values, equal_nan=True):
+                matrix[index[var]] = values
+                changed.add(var)
+
+        if inputs is not None:
+            inputs = inputs.reindex_columns(self.result.columns)
+            for var, values in zip(inputs.names, inputs.matrix):
+                if var not in self.data:
+                    raise KeyError(f"Unknown input variable {var}, re-run the full evaluation to add it")
+                self.data.matrix[self.data.index[var]] = values
+                if var not in self.overlaid:
+                    write(var, values)
+        for var in cleared_overlays:
+            if var not in self.overlaid:
+                continue
+            self.overlaid.discard(var)
+            if var in self.data:
+                write(var, self.data.row(var))
+            elif var in self.position:
+                recompute.add(var)
+            elif var in index:
+                # an input missing from the data, supplied only by the overlay
+                write(var, np.full(len(self.result.columns), np.nan))
+        if overlay_data is not None:
+            overlay_data = overlay_data.reindex_columns(self.result.columns)
+            for var, values in zip(overlay_data.names, overlay_data.matrix):
+                if var not in index:
+                    raise KeyError(f"Unknown overlay variable {var}, re-run the full evaluation to add it")
+                self.overlaid.add(var)
+                write(var, values)
+
+        pending = [self.position[var] for var in recompute]
+        for var in changed:
+            pending.extend(self.position[dependent] for dependent in self.dependents.get(var, ()))
+        heapq.heapify(pending)
+        done = set()
+        while pending:
+            var = self.model.order[heapq.heappop(pending)]
+            if var in done or var in self.overlaid or var in self.data:
+                continue
+            done.add(var)
+            previous = matrix[index[var]].copy()
+            _evaluate_row(self.model, var, matrix, index, self.namespace, self.globals_)
+            if not np.array_equal(previous, matrix[index[var]], equal_nan=True):
+                changed.add(var)
+                for dependent in self.dependents.get(var, ()):
+                    heapq.heappush(pending, self.position[dependent])
+        return changed - self.model.hidden
@@ -0,0 +1,343 @@
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from variable_analysis_engine import MatrixData, read_input_matrix
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Parquet and Arrow files hold one float64 column per variable plus this
+# column of time labels, so each variable's history (a matrix row) is one
+# contiguous column. .npy files hold the variables x time matrix itself,
+# with names and time labels in a <path>.json sidecar.
+TIME_COLUMN = 'time'
+
+PARQUET_EXTENSIONS = ('.parquet', '.pq')
+ARROW_EXTENSIONS = ('.arrow', '.feather', '.ipc')
+
+
+# Reads the comma separated fields of one line of a file a few at a time,
+# so a row with millions of time points is never held in memory at once
+class _LineCursor:
+    def __init__(self, file, start, end):
+        self.file = file
+        self.position = start
+        self.end = end
+        self.pending = b''
+        self.fields = []
+        self.field_size = 16  # running estimate of bytes per field, used to size reads
+
+    def read(self, count):
+        while len(self.fields) < count and self.pending is not None:
+            if self.position < self.end:
+                self.file.seek(self.position)
+                size = max(256, (count - len(self.fields)) * self.field_size)
+                block = self.file.read(min(size, self.end - self.position))
+                self.position += len(block)
+                parts = (self.pending + block).split(b',')
+                self.pending = parts.pop()
+                self.fields.extend(parts)
+                if parts:
+                    self.field_size = max(1, len(block) // len(parts) + 1)
+            else:
+                self.fields.append(self.pending.rstrip(b'\r'))
+                self.pending = None
+        fields, self.fields = self.fields[:count], self.fields[count:]
+        return fields
+
+    def skip(self, count, step=1 << 16):
+        while count > 0:
+            skipped = len(self.read(min(count, step)))
+            if not skipped:
+                break
+            count -= skipped
+
+
+# Function to find the (start, end) byte range of every non-empty line
+def _line_ranges(file, block_size=1 << 20):
+    ranges = []
+    start = position = 0
+    file.seek(0)
+    while True:
+        block = file.read(block_size)
+        if not block:
+            break
+        newline = block.find(b'\n')
+        while newline != -1:
+            if position + newline > start:
+                ranges.append((start, position + newline))
+            start = position + newline + 1
+            newline = block.find(b'\n', newline + 1)
+        position += len(block)
+    if position > start:
+        ranges.append((start, position))
+    return ranges
+
+# Function to convert CSV fields to floats, treating empty fields as missing
+def _parse_floats(fields, length):
+    values = np.full(length, np.nan)
+    if fields:
+        raw = np.array([field.strip() or b'nan' for field in fields])
+        values[:len(fields)] = raw.astype(np.float64)
+    return values
+
+
+# Function to read a variables x time CSV (like input_variable.csv) in chunks
+# of chunk_size time columns, starting at the start_point column. Yields one
+# MatrixData per chunk; variables optionally restricts which rows are read.
+def iter_csv_time_chunks(file_path, chunk_size, start_point=None, variables=None):
+    with open(file_path, 'rb') as file:
+        lines = _line_ranges(file)
+        if not lines:
+            return
+        header = _LineCursor(file, *lines[0])
+        header.read(1)  # the variable_name column
+        names, cursors = [], []
+        for start, end in lines[1:]:
+            cursor = _LineCursor(file, start, end)
+            name = cursor.read(1)[0].decode().strip()
+            if variables is None or name in variables:
+                names.append(name)
+                cursors.append(cursor)
+
+        if start_point is not None:
+            skipped = 0
+            while True:
+                labels = header.read(1)
+                if not labels:
+                    raise KeyError(start_point)
+                if labels[0].decode().strip() == str(start_point):
+                    header.fields.insert(0, labels[0])
+                    break
+                skipped += 1
+            for cursor in cursors:
+                cursor.skip(skipped)
+
+        while True:
+            labels = [label.decode().strip() for label in header.read(chunk_size)]
+            if not labels:
+                break
+            matrix = np.empty((len(cursors), len(labels)))
+            for row, cursor in enumerate(cursors):
+                matrix[row] = _parse_floats(cursor.read(len(labels)), len(labels))
+            yield MatrixData(matrix, names, labels)
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("pyarrow is required to read or write Parquet and Arrow files")
+
+def _extension(path):
+    return os.path.splitext(str(path))[1].lower()
+
+# Function to convert an Arrow table (time column + one column per variable) to a MatrixData
+def _table_to_matrix(table, variables=None):
+    names = [name for name in table.column_names if name != TIME_COLUMN]
+    if variables is not None:
+        names = [name for name in names if name in variables]
+    matrix = np.empty((len(names), table.num_rows))
+    for row, name in enumerate(names):
+        # zero-copy view of the column when it has no nulls, then one copy into the row
+        matrix[row] = table.column(name).to_numpy()
+    columns = table.column(TIME_COLUMN).to_pylist() if TIME_COLUMN in table.column_names else range(table.num_rows)
+    return MatrixData(matrix, names, columns)
+
+def _matrix_to_table(data):
+    arrays = [pa.array([str(column) for column in data.columns])]
+    arrays.extend(pa.array(row) for row in data.matrix)
+    return pa.Table.from_arrays(arrays, names=[TIME_COLUMN] + list(data.names))
+
+def _npy_labels_path(path):
+    return f'{path}.json'
+
+# Function to read a variables x time matrix from CSV, Parquet, Arrow IPC or .npy.
+# .npy files are memory-mapped rather than read into memory; Arrow files are
+# memory-mapped while reading, and their columns copied into the matrix rows.
+def read_matrix(path, variables=None):
+    extension = _extension(path)
+    if extension in PARQUET_EXTENSIONS:
+        _require_pyarrow()
+        columns = None
+        if variables is not None:
+            available = set(pq.read_schema(path).names)
+            columns = [TIME_COLUMN] + [var for var in variables if var in available]
+        return _table_to_matrix(pq.read_table(path, columns=columns, memory_map=True), variables)
+    if extension in ARROW_EXTENSIONS:
+        _require_pyarrow()
+        with pa.memory_map(str(path)) as source:
+            return _table_to_matrix(pa.ipc.open_file(source).read_all(), variables)
+    if extension == '.npy':
+        matrix = np.load(path, mmap_mode='r')
+        with open(_npy_labels_path(path)) as file:
+            labels = json.load(file)
+        data = MatrixData(matrix, labels['variables'], labels['columns'])
+        return data if variables is None else data.select(variables)
+    return read_input_matrix(path, variables)
+
+# Function to write a variables x time matrix to CSV, Parquet, Arrow IPC or .npy.
+# Rows are written straight from the matrix, without building a DataFrame.
+def write_matrix(data, path, block_rows=1024):
+    extension = _extension(path)
+    if extension in PARQUET_EXTENSIONS or extension in ARROW_EXTENSIONS:
+        writer = ChunkWriter(path, data.names)
+        writer.write(data)
+        writer.close()
+    elif extension == '.npy':
+        output = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=data.matrix.shape)
+        for start in range(0, len(data.names), block_rows):
+            output[start:start + block_rows] = data.matrix[start:start + block_rows]
+        output.flush()
+        del output
+        with open(_npy_labels_path(path), 'w') as file:
+            json.dump({'variables': list(data.names), 'columns': [str(column) for column in data.columns]}, file)
+    else:
+        with open(path, 'w') as file:
+            _write_csv_header(file, data.columns)
+            for name, row in zip(data.names, data.matrix):
+                _write_csv_row(file, name, [row])
+    return path
+
+# CSV output is variables x time, like input_variable.csv: a header of time
+# labels, then one line per variable
+def _write_csv_header(file, columns):
+    file.write(','.join(['variable_name'] + [str(column) for column in columns]) + '\n')
+
+def _write_csv_row(file, name, pieces):
+    file.write(name)
+    for piece in pieces:
+        if len(piece):
+            file.write(',' + ','.join(map(repr, piece.tolist())))
+    file.write('\n')
+
+
+# Writes successive time chunks of a result to one file as they are produced.
+# Parquet and Arrow files get one record batch per chunk. A CSV line holds a
+# variable's whole history, so CSV chunks are appended to a temporary binary
+# file (one variables x time block per chunk) and close() writes the lines
+# from it, one variable at a time.
+class ChunkWriter:
+    def __init__(self, path, names):
+        self.path = path
+        self.names = list(names)
+        self.extension = _extension(path)
+        self.writer = None
+        self.spool = None
+        if self.extension in PARQUET_EXTENSIONS or self.extension in ARROW_EXTENSIONS:
+            _require_pyarrow()
+            schema = pa.schema([(TIME_COLUMN, pa.string())] + [(name, pa.float64()) for name in self.names])
+            if self.extension in PARQUET_EXTENSIONS:
+                self.writer = pq.ParquetWriter(path, schema)
+            else:
+                self.writer = pa.ipc.new_file(path, schema)
+        elif self.extension == '.npy':
+            raise ValueError("Chunked output to .npy is not supported, use Parquet, Arrow or CSV")
+        else:
+            directory = os.path.dirname(os.path.abspath(path))
+            self.spool = tempfile.NamedTemporaryFile(dir=directory, suffix='.spool', delete=False)
+            self.columns = []
+            self.widths = []
+
+    def write(self, chunk):
+        if list(chunk.names) != self.names:
+            raise ValueError("Every chunk must contain the same variables")
+        if self.writer is not None:
+            self.writer.write_table(_matrix_to_table(chunk))
+        else:
+            self.spool.write(np.ascontiguousarray(chunk.matrix, dtype=np.float64).tobytes())
+            self.columns.extend(chunk.columns)
+            self.widths.append(len(chunk.columns))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            return
+        self.spool.close()
+        try:
+            values = np.memmap(self.spool.name, dtype=np.float64, mode='r') if sum(self.widths) else np.empty(0)
+            blocks, start = [], 0
+            for width in self.widths:
+                blocks.append(values[start:start + len(self.names) * width].reshape(len(self.names), width))
+                start += len(self.names) * width
+            with open(self.path, 'w') as file:
+                _write_csv_header(file, self.columns)
+                for row, name in enumerate(self.names):
+                    _write_csv_row(file, name, [block[row] for block in blocks])
+            del values, blocks
+        finally:
+            os.remove(self.spool.name)
+
+# Function to write streamed result chunks to output_path (CSV, Parquet or Arrow)
+def write_chunks(chunks, output_path):
+    writer = None
+    try:
+        for chunk in chunks:
+            if writer is None:
+                writer = ChunkWriter(output_path, chunk.names)
+            writer.write(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return output_path
+
+# Function to read any supported input in chunks of chunk_size time points,
+# starting at the start_point column
+def iter_time_chunks(path, chunk_size, start_point=None, variables=None):
+    extension = _extension(path)
+    if extension not in PARQUET_EXTENSIONS + ARROW_EXTENSIONS + ('.npy',):
+        yield from iter_csv_time_chunks(path, chunk_size, start_point, variables)
+        return
+
+    if extension in PARQUET_EXTENSIONS:
+        _require_pyarrow()
+        file = pq.ParquetFile(path)
+        names = [name for name in file.schema_arrow.names if name != TIME_COLUMN
+                 and (variables is None or name in variables)]
+        labels = pq.read_table(path, columns=[TIME_COLUMN]).column(TIME_COLUMN).to_pylist()
+        start = labels.index(str(start_point)) if start_point is not None else 0
+        batches = file.iter_batches(batch_size=chunk_size, columns=[TIME_COLUMN] + names)
+        yield from _iter_batch_chunks(batches, start, variables)
+        return
+
+    if extension in ARROW_EXTENSIONS:
+        # record batches are sliced straight from the memory map, so only one
+        # chunk at a time is copied into memory
+        _require_pyarrow()
+        with pa.memory_map(str(path)) as source:
+            reader = pa.ipc.open_file(source)
+            batches = [reader.get_batch(position) for position in range(reader.num_record_batches)]
+            start = 0
+            if start_point is not None:
+                labels = [label for batch in batches for label in batch.column(TIME_COLUMN).to_pylist()]
+                start = labels.index(str(start_point))
+            pieces = (batch.slice(offset, chunk_size) for batch in batches
+                      for offset in range(0, batch.num_rows, chunk_size))
+            yield from _iter_batch_chunks(pieces, start, variables)
+        return
+
+    matrix = np.load(path, mmap_mode='r')
+    with open(_npy_labels_path(path)) as file:
+        labels = json.load(file)
+    rows = [row for row, name in enumerate(labels['variables']) if variables is None or name in variables]
+    names = [labels['variables'][row] for row in rows]
+    columns = labels['columns']
+    start = columns.index(str(start_point)) if start_point is not None else 0
+    for offset in range(start, len(columns), chunk_size):
+        # only this chunk's block of the memory-mapped rows is read
+        yield MatrixData(np.asarray(matrix[rows, offset:offset + chunk_size], dtype=np.float64),
+                         names, columns[offset:offset + chunk_size])
+
+# Function to convert record batches to MatrixData chunks, skipping the
+# first start time points
+def _iter_batch_chunks(batches, start, variables):
+    position = 0
+    for batch in batches:
+        table = pa.Table.from_batches([batch])
+        if position + table.num_rows > start:
+            yield _table_to_matrix(table.slice(max(0, start - position)), variables)
+        position += table.num_rows
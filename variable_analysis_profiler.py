@@ -0,0 +1,111 @@
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+
+# Opt-in instrumentation for the formula engine. Evaluation functions take
+# profiler=None by default and only check it once per formula batch, so a
+# run without a profiler pays next to nothing. With track_allocations the
+# profiler starts tracemalloc if needed and stops it again in close(), so
+# later runs are not slowed down; use it as a context manager or call close().
+class Profiler:
+    def __init__(self, track_allocations=False):
+        self.track_allocations = track_allocations
+        self.phases = {}   # phase name -> seconds
+        self.nodes = {}    # variable -> {'seconds', 'allocated_bytes', 'output_bytes'}
+        self.events = []   # (name, category, start, seconds, args) for the trace export
+        self._origin = time.perf_counter()
+        self._started_tracing = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Function to stop allocation tracing, if this profiler started it
+    def close(self):
+        if self._started_tracing and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._started_tracing = False
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+            self.events.append((name, 'phase', start - self._origin, seconds, {}))
+
+    # Function to time one evaluation step that computes the given variables.
+    # A batch is timed as a whole and its cost split evenly between its members.
+    # Returns the step's result; output_bytes defaults to that result's size.
+    def measure(self, variables, step, output_bytes=None):
+        if self.track_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        if self.track_allocations:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        result = step()
+        seconds = time.perf_counter() - start
+        allocated = tracemalloc.get_traced_memory()[1] - before if self.track_allocations else 0
+        if output_bytes is None:
+            output_bytes = int(getattr(result, 'nbytes', 0))
+
+        share = len(variables)
+        for var in variables:
+            self.nodes[var] = {'seconds': seconds / share, 'allocated_bytes': allocated // share,
+                               'output_bytes': output_bytes}
+        name = variables[0] if share == 1 else f'{variables[0]} (+{share - 1} batched)'
+        self.events.append((name, 'formula', start - self._origin, seconds,
+                            {'variables': share, 'allocated_bytes': allocated}))
+        return result
+
+    # Function to find the most expensive dependency chain through the graph
+    def critical_path(self, model):
+        finish, previous = {}, {}
+        for var in model.order:
+            best = max((dep for dep in model.dependencies[var] if dep in finish),
+                       key=lambda dep: finish[dep], default=None)
+            own = self.nodes.get(var, {}).get('seconds', 0.0)
+            finish[var] = own + (finish[best] if best is not None else 0.0)
+            previous[var] = best
+        if not finish:
+            return [], 0.0
+        var = max(finish, key=finish.get)
+        total, path = finish[var], []
+        while var is not None:
+            path.append(var)
+            var = previous[var]
+        return path[::-1], total
+
+    def to_dict(self, model=None):
+        report = {'phases': self.phases, 'nodes': self.nodes}
+        if model is not None:
+            path, seconds = self.critical_path(model)
+            report['critical_path'] = {'variables': path, 'seconds': seconds}
+        return report
+
+    def to_json(self, path, model=None):
+        with open(path, 'w') as file:
+            json.dump(self.to_dict(model), file, indent=2)
+        return path
+
+    # Function to export a trace viewable in chrome://tracing or Perfetto
+    def to_chrome_trace(self, path):
+        events = [{'name': name, 'cat': category, 'ph': 'X', 'ts': start * 1e6, 'dur': seconds * 1e6,
+                   'pid': 0, 'tid': 0 if category == 'phase' else 1, 'args': args}
+                  for name, category, start, seconds, args in self.events]
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+        return path
+
+
+# Function to time a phase when profiling, and do nothing otherwise
+def profile_phase(profiler, name):
+    return profiler.phase(name) if profiler is not None else nullcontext()
@@ -2,6 +2,7 @@
 import pandas as pd
 import re
 from collections import defaultdict
+from variable_analysis_engine import topological_order
 
 # Function to read input data
 def read_input_data(file_path):
@@ -39,8 +40,7 @@ def ret(series):
     return series.pct_change()
 
 def evaluate_formula(formula, data):
-    for var in re.findall(r'x\d+', formula):
-        formula = formula.replace(var, f'data["{var}"]')
+    formula = re.sub(r'\bx\d+\b', lambda match: f'data["{match.group(0)}"]', formula)
     try:
         return eval(formula)
     except Exception as e:
@@ -49,26 +49,11 @@ def evaluate_formula(formula, data):
 
 # Function to evaluate dependencies
 def evaluate_dependencies(dependency_graph, data, formulas):
-    calculated_values = {}
-    
-    def calculate_variable(var):
-        if var in data:
-            return data[var]
-        if var in calculated_values:
-            return calculated_values[var]
-        
-        formula = formulas[var]
-        for dependency in dependency_graph[var]:
-            if dependency not in calculated_values:
-                calculate_variable(dependency)
-
-        calculated_values[var] = evaluate_formula(formula, {**data, **calculated_values})
-        return calculated_values[var]
-
-    for variable in dependency_graph:
-        calculate_variable(variable)
-    
-    return {**data, **calculated_values}
+    namespace = dict(data)
+    for var in topological_order(dependency_graph):
+        if var not in namespace:
+            namespace[var] = evaluate_formula(formulas[var], namespace)
+    return namespace
 
 # Main function to run the analysis
 def main(input_csv_path, formulas_txt_path):
@@ -4,6 +4,8 @@ import re
 import networkx as nx
 import matplotlib.pyplot as plt
 from collections import defaultdict
+from variable_analysis_engine import evaluate_stream, load_compiled_model, topological_order
+from variable_analysis_io import iter_time_chunks, read_matrix, write_chunks
 
 # Function to read and filter input data based on the starting point
 def read_and_filter_data(file_path, start_point):
@@ -43,8 +45,7 @@ def ret(series):
     return series.pct_change()
 
 def evaluate_formula(formula, data):
-    for var in re.findall(r'x\d+', formula):
-        formula = formula.replace(var, f'data["{var}"]')
+    formula = re.sub(r'\bx\d+\b', lambda match: f'data["{match.group(0)}"]', formula)
     try:
         return eval(formula)
     except KeyError as e:
@@ -54,31 +55,14 @@ def evaluate_formula(formula, data):
         print(f"Error evaluating formula {formula}: {e}")
         return pd.Series(dtype=float)
 
-# Function to evaluate dependencies
+# Function to evaluate dependencies. Overlay values take priority over input
+# data, which takes priority over formulas, the same rule stream_analysis uses.
 def evaluate_dependencies(dependency_graph, data, formulas, overlay_data):
-    calculated_values = {}
-    
-    def calculate_variable(var):
-        if var in data:
-            return data[var]
-        if var in overlay_data:
-            calculated_values[var] = overlay_data[var]
-            return overlay_data[var]
-        if var in calculated_values:
-            return calculated_values[var]
-        
-        formula = formulas[var]
-        for dependency in dependency_graph[var]:
-            if dependency not in calculated_values:
-                calculate_variable(dependency)
-
-        calculated_values[var] = evaluate_formula(formula, {**data, **calculated_values})
-        return calculated_values[var]
-
-    for variable in dependency_graph:
-        calculate_variable(variable)
-    
-    return {**data, **calculated_values}
+    namespace = {**data, **overlay_data}
+    for var in topological_order(dependency_graph):
+        if var not in namespace:
+            namespace[var] = evaluate_formula(formulas[var], namespace)
+    return namespace
 
 # Function to visualize the dependency graph
 def visualize_dependency_graph(dependency_graph):
@@ -95,8 +79,25 @@ def visualize_dependency_graph(dependency_graph):
     plt.title("Dependency Graph")
     plt.show()
 
-# Main function to run the analysis
-def main(input_csv_path, formulas_txt_path, overlay_csv_path, start_point):
+# Function to run the analysis chunk by chunk over the time columns, for
+# histories too long to load at once. Inputs may be CSV, Parquet, Arrow or .npy;
+# results are written to output_path as CSV, Parquet or Arrow. Overlay values
+# take priority over input data, as in evaluate_dependencies.
+def stream_analysis(input_csv_path, formulas_txt_path, overlay_csv_path, start_point, chunk_size, output_path):
+    model = load_compiled_model(formulas_txt_path)
+    input_chunks = iter_time_chunks(input_csv_path, chunk_size, start_point)
+    overlay_data = read_matrix(overlay_csv_path)
+    return write_chunks(evaluate_stream(model, input_chunks, overlay_data), output_path)
+
+# Main function to run the analysis. With chunk_size the result is streamed
+# to output_path (variables x time, like the input) and the path is returned.
+def main(input_csv_path, formulas_txt_path, overlay_csv_path, start_point, chunk_size=None, output_path=None):
+    if chunk_size is not None:
+        if output_path is None:
+            raise ValueError("Streaming with a chunk_size needs an output_path")
+        return stream_analysis(input_csv_path, formulas_txt_path, overlay_csv_path, start_point,
+                               chunk_size, output_path)
+
     input_data = read_and_filter_data(input_csv_path, start_point)
     overlay_data = read_and_filter_data(overlay_csv_path, start_point)
     with open(formulas_txt_path, 'r') as file:
@@ -114,11 +115,14 @@ if __name__ == "__main__":
     import sys
 
     if len(sys.argv) < 5:
-        print("Usage: python script.py <input_csv_path> <formulas_txt_path> <overlay_csv_path> <start_point>")
+        print("Usage: python script.py <input_csv_path> <formulas_txt_path> <overlay_csv_path> <start_point> "
+              "[<chunk_size> <output_csv_path>]")
     else:
         input_csv_path = sys.argv[1]
         formulas_txt_path = sys.argv[2]
         overlay_csv_path = sys.argv[3]
         start_point = sys.argv[4]
-        result = main(input_csv_path, formulas_txt_path, overlay_csv_path, start_point)
+        chunk_size = int(sys.argv[5]) if len(sys.argv) > 5 else None
+        output_path = sys.argv[6] if len(sys.argv) > 6 else None
+        result = main(input_csv_path, formulas_txt_path, overlay_csv_path, start_point, chunk_size, output_path)
         print(result)
@@ -4,6 +4,7 @@ import re
 import networkx as nx
 import matplotlib.pyplot as plt
 from collections import defaultdict
+from variable_analysis_engine import topological_order
 
 # Function to read input data
 def read_input_data(file_path):
@@ -41,8 +42,7 @@ def ret(series):
     return series.pct_change()
 
 def evaluate_formula(formula, data):
-    for var in re.findall(r'x\d+', formula):
-        formula = formula.replace(var, f'data["{var}"]')
+    formula = re.sub(r'\bx\d+\b', lambda match: f'data["{match.group(0)}"]', formula)
     try:
         return eval(formula)
     except Exception as e:
@@ -51,26 +51,11 @@ def evaluate_formula(formula, data):
 
 # Function to evaluate dependencies
 def evaluate_dependencies(dependency_graph, data, formulas):
-    calculated_values = {}
-    
-    def calculate_variable(var):
-        if var in data:
-            return data[var]
-        if var in calculated_values:
-            return calculated_values[var]
-        
-        formula = formulas[var]
-        for dependency in dependency_graph[var]:
-            if dependency not in calculated_values:
-                calculate_variable(dependency)
-
-        calculated_values[var] = evaluate_formula(formula, {**data, **calculated_values})
-        return calculated_values[var]
-
-    for variable in dependency_graph:
-        calculate_variable(variable)
-    
-    return {**data, **calculated_values}
+    namespace = dict(data)
+    for var in topological_order(dependency_graph):
+        if var not in namespace:
+            namespace[var] = evaluate_formula(formulas[var], namespace)
+    return namespace
 
 # Function to visualize the dependency graph
 def visualize_dependency_graph(dependency_graph):